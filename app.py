@@ -1,57 +1,168 @@
 # -*- coding: utf-8 -*-
 import os
+import socket
 import sys
 
 from flask import Flask
-from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager
-from flask_socketio import SocketIO
 
-# logging.basicConfig(level='INFO')
+from log import setup_logging, parse_sample_rates
 
 
 # Windows系统，使用三个斜线
 WIN = sys.platform.startswith('win')
 prefix = 'sqlite:///' if WIN else 'sqlite:////'
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(app.root_path, 'data.db')
-
-
-# chrome samesite设置，允许跨域携带cookie
-# https://learn.microsoft.com/zh-cn/azure/active-directory/develop/howto-handle-samesite-cookie-changes-chrome-browser
-app.config['REMEMBER_COOKIE_SAMESITE'] = "None"
-app.config['REMEMBER_COOKIE_SECURE'] = True
-
-
-# 允许全局跨域
-cors = CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
-
-
-# 数据库
-db = SQLAlchemy(app)
-
-
-# websocket
-socketio = SocketIO(app)
-socketio.init_app(app, cors_allowed_origins='*')
-socketio_namespace = '/room'
-
-
-# 用户登录
-login_manager = LoginManager(app)
-login_manager.login_view = 'sign_in'
-
-
-# 加载views中逻辑函数，models中数据模型，不可删除
-from view.auth import *
-from view.logit import *
+# 组件及其依赖：auth为登录注册接口和登录会话（初始化数据库），logit为房间接口和/room命名空间的socket事件，
+# monitor为/metrics接口，socketio为websocket服务端（只发送消息的后台worker也需要）
+COMPONENTS = {
+    'auth': (),
+    'logit': ('auth', 'socketio'),
+    'monitor': (),
+    'socketio': (),
+}
+
+
+def configure(app: Flask, config: dict = None):
+    # 默认配置从环境变量读取，config中的项覆盖默认值
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', prefix + os.path.join(app.root_path, 'data.db'))
+    # SQLite连接池的大小和溢出连接数
+    app.config['DATABASE_POOL_SIZE'] = int(os.getenv('DATABASE_POOL_SIZE', 8))
+    app.config['DATABASE_POOL_OVERFLOW'] = int(os.getenv('DATABASE_POOL_OVERFLOW', 16))
+    # 登录用户缓存的容量和过期时间（秒）
+    app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 4096))
+    app.config['USER_CACHE_TTL'] = float(os.getenv('USER_CACHE_TTL', 300))
+    # 密码散列线程池的线程数和最大排队数，排队已满时登录注册请求直接返回繁忙
+    app.config['PASSWORD_POOL_SIZE'] = int(os.getenv('PASSWORD_POOL_SIZE', 4))
+    app.config['PASSWORD_POOL_PENDING'] = int(os.getenv('PASSWORD_POOL_PENDING', 32))
+    # 日志等级，以及高频socket事件的日志采样率（每N条记录1条）
+    app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO')
+    app.config['LOG_SAMPLE_RATES'] = parse_sample_rates(
+        os.getenv('LOG_SAMPLE_RATES', 'updateInfo=100,clockPong=100,updateState=10'))
+
+    # chrome samesite设置，允许跨域携带cookie
+    # https://learn.microsoft.com/zh-cn/azure/active-directory/develop/howto-handle-samesite-cookie-changes-chrome-browser
+    app.config['REMEMBER_COOKIE_SAMESITE'] = "None"
+    app.config['REMEMBER_COOKIE_SECURE'] = True
+
+    # 房间共享存储，未配置时房间只保存在当前进程内存中，例如 redis://localhost:6379/0
+    app.config['ROOM_STORE_URL'] = os.getenv('ROOM_STORE_URL')
+    # 进程内存储的房间日志目录，配置后房间状态写入追加日志和压缩快照，重启时回放恢复
+    # 日志记录数或距上次快照的时间（秒）超过阈值时重新生成快照并清空日志
+    app.config['ROOM_JOURNAL_DIR'] = os.getenv('ROOM_JOURNAL_DIR')
+    app.config['ROOM_JOURNAL_COMPACT_EVERY'] = int(os.getenv('ROOM_JOURNAL_COMPACT_EVERY', 10000))
+    app.config['ROOM_JOURNAL_COMPACT_INTERVAL'] = float(os.getenv('ROOM_JOURNAL_COMPACT_INTERVAL', 300))
+    # 多个worker进程之间转发socket消息的队列，未配置时与房间存储使用同一个Redis
+    app.config['SOCKETIO_MESSAGE_QUEUE'] = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+    # 房间分片：配置WORKER_URL（本worker对外地址）后按room_number一致性哈希把房间分配给各worker，需配合ROOM_STORE_URL使用
+    app.config['WORKER_ID'] = os.getenv('WORKER_ID', '%s:%d' % (socket.gethostname(), os.getpid()))
+    app.config['WORKER_URL'] = os.getenv('WORKER_URL')
+    app.config['SHARD_REPLICAS'] = int(os.getenv('SHARD_REPLICAS', 64))
+    app.config['SHARD_HEARTBEAT'] = float(os.getenv('SHARD_HEARTBEAT', 5))
+
+    # websocket，异步模式默认自动选择（eventlet > gevent > threading），asyncio入口asgi.py使用threading
+    app.config['SOCKETIO_ASYNC_MODE'] = os.getenv('SOCKETIO_ASYNC_MODE')
+    # 房间进度和状态上报的合并广播间隔（秒），小于等于0时每次上报立即广播
+    app.config['ROOM_FLUSH_INTERVAL'] = float(os.getenv('ROOM_FLUSH_INTERVAL', 0.5))
+    # 播放偏差纠正：检查间隔（秒，小于等于0时关闭），容差和直接跳转的阈值（秒），
+    # 调整播放速率追上偏差的时间窗口（秒）和速率最大调整幅度，超过DRIFT_MAX_REPORT_AGE秒未上报进度的成员不参与计算
+    app.config['DRIFT_CHECK_INTERVAL'] = float(os.getenv('DRIFT_CHECK_INTERVAL', 2))
+    app.config['DRIFT_TOLERANCE'] = float(os.getenv('DRIFT_TOLERANCE', 0.3))
+    app.config['DRIFT_SEEK_THRESHOLD'] = float(os.getenv('DRIFT_SEEK_THRESHOLD', 2))
+    app.config['DRIFT_CORRECTION_WINDOW'] = float(os.getenv('DRIFT_CORRECTION_WINDOW', 10))
+    app.config['DRIFT_MAX_RATE_ADJUST'] = float(os.getenv('DRIFT_MAX_RATE_ADJUST', 0.05))
+    app.config['DRIFT_MAX_REPORT_AGE'] = float(os.getenv('DRIFT_MAX_REPORT_AGE', 5))
+    # 每个连接发送积压（engine.io队列中的数据包数）的上限，超过后房间状态消息只保留最新一条，小于等于0时不限制
+    # 积压持续超过OUTBOX_SLOW_TIMEOUT秒的连接被断开；OUTBOX_DRAIN_INTERVAL为暂存消息的重试发送间隔（秒）
+    app.config['OUTBOX_MAX_BACKLOG'] = int(os.getenv('OUTBOX_MAX_BACKLOG', 16))
+    app.config['OUTBOX_SLOW_TIMEOUT'] = float(os.getenv('OUTBOX_SLOW_TIMEOUT', 30))
+    app.config['OUTBOX_DRAIN_INTERVAL'] = float(os.getenv('OUTBOX_DRAIN_INTERVAL', 0.2))
+    # sync同步屏障等待成员就绪的超时时间（秒），超时后放弃等待未就绪成员直接播放，小于等于0时不超时
+    app.config['SYNC_BARRIER_TIMEOUT'] = float(os.getenv('SYNC_BARRIER_TIMEOUT', 10))
+    # 成员socket断开后保留在房间中的宽限期（秒），超时未重连则移出房间，房间没有成员后删除，小于等于0时不清理
+    app.config['MEMBER_GRACE_PERIOD'] = float(os.getenv('MEMBER_GRACE_PERIOD', 120))
+    # socket断开后恢复令牌的有效期（秒），期间成员状态保持不变，携带令牌重连时静默恢复，小于等于0时不签发令牌
+    app.config['RESUME_WINDOW'] = float(os.getenv('RESUME_WINDOW', 15))
+    # 清理定时器时间轮的tick（秒）和槽数
+    app.config['REAPER_TICK'] = float(os.getenv('REAPER_TICK', 1))
+    app.config['REAPER_SLOTS'] = int(os.getenv('REAPER_SLOTS', 512))
+    # 时钟同步：clockPing发送间隔（秒），播放暂停指令执行时间在最大单程时延之外额外预留的余量和上限（毫秒）
+    app.config['CLOCK_PING_INTERVAL'] = float(os.getenv('CLOCK_PING_INTERVAL', 5))
+    app.config['CLOCK_LEAD_MARGIN'] = int(os.getenv('CLOCK_LEAD_MARGIN', 50))
+    app.config['CLOCK_LEAD_MAX'] = int(os.getenv('CLOCK_LEAD_MAX', 1000))
+
+    # 不小于COMPRESS_MIN_SIZE字节的JSON和HTML响应按Accept-Encoding使用br或gzip压缩，以及按请求压缩的级别
+    app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', 500))
+    app.config['COMPRESS_GZIP_LEVEL'] = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+    app.config['COMPRESS_BR_QUALITY'] = int(os.getenv('COMPRESS_BR_QUALITY', 4))
+    # 启动时预先渲染的静态页面（登录注册页、隐私政策页）的浏览器缓存时间（秒）
+    app.config['STATIC_PAGE_MAX_AGE'] = int(os.getenv('STATIC_PAGE_MAX_AGE', 86400))
+
+    app.config.update(config or {})
+    if app.config['SOCKETIO_MESSAGE_QUEUE'] is None:
+        app.config['SOCKETIO_MESSAGE_QUEUE'] = app.config['ROOM_STORE_URL']
+
+
+def create_app(config: dict = None, components=tuple(COMPONENTS)) -> Flask:
+    # 只初始化components中的组件及其依赖，用不到的数据库、websocket和视图模块不导入，
+    # 例如只发送消息的清理worker可以使用 create_app(components=('socketio',))
+    # 房间状态和后台任务是进程内单例，每个进程只创建一个应用
+    enabled = set()
+    pending = list(components)
+    while pending:
+        name = pending.pop()
+        if name not in enabled:
+            enabled.add(name)
+            pending.extend(COMPONENTS[name])
+
+    app = Flask(__name__)
+    configure(app, config)
+
+    # 日志在后台线程中格式化和写出，socket事件处理只负责入队
+    setup_logging(app.logger, app.config['LOG_LEVEL'], app.config['LOG_SAMPLE_RATES'])
+
+    # 允许全局跨域
+    from flask_cors import CORS
+    CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+
+    # JSON和HTML响应压缩
+    import compression
+    compression.init_app(app)
+
+    with app.app_context():
+        if 'socketio' in enabled:
+            from extensions import socketio
+            socketio.init_app(app, cors_allowed_origins='*', message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                              async_mode=app.config['SOCKETIO_ASYNC_MODE'])
+
+        if 'auth' in enabled:
+            import models
+            from extensions import login_manager
+            from view.auth import bp as auth_bp
+            models.init_app(app)
+            login_manager.init_app(app)
+            app.register_blueprint(auth_bp)
+
+        # 视图模块在应用上下文中导入，模块中创建的单例读取的是本应用的配置
+        if 'logit' in enabled:
+            from view.logit import bp as logit_bp
+            app.register_blueprint(logit_bp)
+
+        if 'monitor' in enabled:
+            from view.monitor import bp as monitor_bp
+            app.register_blueprint(monitor_bp)
+
+    return app
 
 
 if __name__ == '__main__':
+    from extensions import socketio
+    from models import migrate_db
+    app = create_app()
+    with app.app_context():
+        migrate_db()
+
     # http_server = WSGIServer(('0.0.0.0', 5000), app, handler_class=WebSocketHandler, keyfile='san_domain_com.key',
     # certfile='san_domain_com.crt') http_server.serve_forever()
 
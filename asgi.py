@@ -0,0 +1,127 @@
+# asyncio模式入口：用python-socketio的AsyncServer和ASGI服务器（uvicorn）提供与socketio.run相同的/room命名空间和HTTP路由，
+# 不依赖eventlet/gevent的monkey patch。Flask-SocketIO中登记的事件处理函数和Flask路由原样复用
+# 用法: python asgi.py [--host 0.0.0.0] [--port 5000] [--keyfile cert/private.key --certfile cert/certificate.crt]
+#      或 uvicorn asgi:application
+import os
+os.environ.setdefault('SOCKETIO_ASYNC_MODE', 'threading')
+
+import argparse
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import socketio as python_socketio
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+from app import create_app
+from extensions import socketio
+
+
+class AsyncBridge:
+    # 代替Flask-SocketIO内部的同步socketio.Server：同步代码中的emit、join_room等转交给事件循环中的AsyncServer，
+    # 事件处理函数在线程池中执行，同一房间的修改由房间锁串行，不同房间并行
+    def __init__(self, sio, workers: int = 8):
+        self.sio = sio
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='room-worker')
+        self.loop = None
+        self.eio = sio.eio  # Outbox读取engine.io发送队列长度
+        self.manager = sio.manager
+
+    def startup(self):
+        self.loop = asyncio.get_running_loop()
+
+    def register(self, server):
+        # 注册通过@socketio.on登记在同步Server上的处理函数
+        for namespace, handlers in server.handlers.items():
+            for event, handler in handlers.items():
+                self.sio.on(event, self._wrap(handler), namespace=namespace)
+
+    def _wrap(self, handler):
+        async def wrapper(*args):
+            return await self.run(handler, *args)
+        return wrapper
+
+    async def run(self, func, *args, **kwargs):
+        # 在工作线程中、应用上下文内执行同步函数
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(self._call, func, *args, **kwargs))
+
+    @staticmethod
+    def _call(func, *args, **kwargs):
+        with app.app_context():
+            return func(*args, **kwargs)
+
+    def _submit(self, coro):
+        if self.loop is None:
+            coro.close()
+            app.logger.warning('asyncio server not started, drop socket operation')
+            return
+        asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # 以下为Flask-SocketIO调用的同步Server接口
+    def emit(self, event, *args, namespace=None, to=None, room=None, skip_sid=None, callback=None, **kwargs):
+        data = args[0] if len(args) == 1 else (tuple(args) if args else None)
+        self._submit(self.sio.emit(event, data, to=to or room, skip_sid=skip_sid, namespace=namespace, **kwargs))
+
+    def enter_room(self, sid, room, namespace=None):
+        self._submit(self.sio.enter_room(sid, room, namespace=namespace))
+
+    def leave_room(self, sid, room, namespace=None):
+        self._submit(self.sio.leave_room(sid, room, namespace=namespace))
+
+    def close_room(self, room, namespace=None):
+        self._submit(self.sio.close_room(room, namespace=namespace))
+
+    def rooms(self, sid, namespace=None):
+        return self.sio.rooms(sid, namespace=namespace)
+
+    def disconnect(self, sid, namespace=None):
+        self._submit(self.sio.disconnect(sid, namespace=namespace))
+
+    def get_environ(self, sid, namespace=None):
+        environ = self.sio.get_environ(sid, namespace=namespace)
+        if environ is not None:
+            environ.setdefault('flask.app', app)
+            environ.setdefault('wsgi.url_scheme', environ['asgi.scope'].get('scheme', 'http'))
+        return environ
+
+    def start_background_task(self, target, *args, **kwargs):
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
+
+    def sleep(self, seconds: float = 0):
+        time.sleep(seconds)
+
+
+app = create_app()
+message_queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+sio = python_socketio.AsyncServer(
+    async_mode='asgi', cors_allowed_origins='*',
+    client_manager=python_socketio.AsyncRedisManager(message_queue) if message_queue else None)
+bridge = AsyncBridge(sio, int(os.getenv('ASYNC_ROOM_WORKERS', 8)))
+bridge.register(socketio.server)
+socketio.server = bridge
+
+# HTTP路由在线程池中以WSGI方式执行
+http_app = WSGIMiddleware(app, workers=int(os.getenv('ASYNC_HTTP_WORKERS', 16)))
+application = python_socketio.ASGIApp(sio, other_asgi_app=http_app, on_startup=bridge.startup)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    from models import migrate_db
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--keyfile')
+    parser.add_argument('--certfile')
+    args = parser.parse_args()
+
+    with app.app_context():
+        migrate_db()
+
+    uvicorn.run(application, host=args.host, port=args.port, ssl_keyfile=args.keyfile, ssl_certfile=args.certfile)
@@ -0,0 +1,95 @@
+# 响应压缩基准测试：在测试客户端中分别以不压缩、gzip和br请求登录页、隐私政策页和N人房间的/profile，
+# 测量每次请求的响应字节数和CPU耗时，以及生成响应体本身（渲染模板、预先渲染的页面、压缩）的CPU耗时；
+# 页面另外测量改动前每次请求渲染模板的处理函数作为对照，输出JSON格式结果
+# 用法: python bench/compression.py [--members 20] [--repeat 500] [--output result.json]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ENCODINGS = ('identity', 'gzip', 'br')
+
+
+def measure(client, path: str, repeat: int, encoding: str, rounds: int = 5) -> dict:
+    # 分多轮执行，取每次请求CPU耗时最少的一轮，减少GC和调度的干扰
+    headers = {'Accept-Encoding': encoding}
+    size = len(client.get(path, headers=headers).data)
+    timings = []
+    for _ in range(rounds):
+        start = time.process_time()
+        for _ in range(max(1, repeat // rounds)):
+            client.get(path, headers=headers)
+        timings.append((time.process_time() - start) / max(1, repeat // rounds))
+    return {'bytes': size, 'cpu_us': round(min(timings) * 1e6, 1)}
+
+
+def cpu_us(func, repeat: int) -> float:
+    start = time.process_time()
+    for _ in range(repeat):
+        func()
+    return round((time.process_time() - start) / repeat * 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--members', type=int, default=20, help='/profile所在房间的成员数')
+    parser.add_argument('--repeat', type=int, default=500)
+    parser.add_argument('--output', help='结果写入文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    from flask import render_template
+    import compression
+    from app import create_app
+    from models import db
+    from sync import Manage, User
+
+    app = create_app()
+    from view.auth import pages
+    # 对照：改动前的页面处理函数，每次请求渲染模板
+    app.add_url_rule('/bench-render/<name>', 'bench_render', lambda name: render_template(name))
+    with app.app_context():
+        db.create_all()
+
+    client = app.test_client()
+    client.post('/sign-up', json={'account': 'owner@bench', 'password': 'pw', 'nickname': 'owner'})
+    client.post('/create-room', json={'tabId': '0', 'roomNumber': 'bench', 'roomUrl': 'https://example.com/bench'})
+    with app.app_context():
+        manage = Manage()
+        room = manage.get_room('bench')
+        for i in range(1, args.members):
+            user = User('member%d@bench' % i, 'member%d' % i, str(i))
+            manage.join(room, user)
+            room.update_user(user.email, socketio=True, video_state='onplaying', video_progress=1234.5 + i)
+
+    results = {}
+    for name, path in (('login', '/sign-in'), ('policy', '/policy'), ('profile', '/profile')):
+        results[name] = {encoding: measure(client, path, args.repeat, encoding) for encoding in ENCODINGS}
+        raw = client.get(path).data
+        # 只计生成响应体的CPU耗时：页面为改动前的每次渲染模板与改动后的预先渲染，JSON为每次请求的压缩
+        with app.test_request_context(path):
+            if name == 'profile':
+                for encoding in ENCODINGS[1:]:
+                    results[name][encoding]['compress_cpu_us'] = cpu_us(lambda: compression.compress(raw, encoding),
+                                                                        args.repeat)
+            else:
+                template = name + '.html'
+                results[name]['identity']['render_cpu_us'] = cpu_us(lambda: render_template(template), args.repeat)
+                results[name]['identity']['cached_cpu_us'] = cpu_us(lambda: pages[template].response(), args.repeat)
+    for name, template in (('login', 'login.html'), ('policy', 'policy.html')):
+        results[name]['render_per_request'] = measure(client, '/bench-render/' + template, args.repeat, 'identity')
+
+    output = json.dumps({'members': args.members, 'repeat': args.repeat, 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
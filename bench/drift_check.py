@@ -0,0 +1,76 @@
+# 偏差检测基准测试：构造M个房间每个N名播放中的成员，分别用numpy和逐个成员计算的方式执行一次完整的检查
+# （从成员表筛选参与计算的行、偏差检测、找出需要纠正的成员），并测量单次进度上报更新成员表的开销，输出JSON格式结果
+# 用法: python bench/drift_check.py [--rooms 5000] [--members 6] [--repeat 20] [--output result.json]
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import drift
+
+
+def make_table(rooms: int, members: int, now: int) -> drift.MemberTable:
+    # 少量成员已暂停或上报过旧，不参与计算
+    table = drift.MemberTable()
+    for r in range(rooms):
+        position, at = random.uniform(0, 3600), now - random.randint(0, 60000)
+        for m in range(members):
+            table.add('%d-%d' % (r, m), reference=position, reference_at=at,
+                      progress=position + (now - at) / 1000 + random.gauss(0, 1),
+                      progress_at=now - random.randint(0, 6000), rate=random.choice((1, 1, 1, 0.95, 1.05)),
+                      playing=random.random() > 0.05)
+    return table
+
+
+def measure(table: drift.MemberTable, now: int, repeat: int) -> dict:
+    timings, selected = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        keys, columns = table.select(now, 5000)
+        _, _, action, _ = drift.detect(*columns, now, 0.3, 2, 10, 0.05)
+        corrections = [keys[i] for i in drift.corrections(action)]
+        timings.append((time.perf_counter() - start) * 1000)
+        selected = len(keys)
+    timings.sort()
+
+    # 单次进度上报只更新对应的一行
+    keys = list(table.rows)
+    start = time.perf_counter()
+    for key in keys[:10000]:
+        table.update(key, progress=1, progress_at=now, playing=True)
+    update_us = (time.perf_counter() - start) / min(len(keys), 10000) * 1e6
+    return {'p50_ms': round(timings[len(timings) // 2], 3), 'max_ms': round(timings[-1], 3), 'selected': selected,
+            'corrections': len(corrections), 'update_us': round(update_us, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=5000)
+    parser.add_argument('--members', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help='结果写入文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    now = int(time.time() * 1000)
+    result = {'rooms': args.rooms, 'members': args.rooms * args.members}
+    if drift.load_numpy() is not None:
+        random.seed(0)
+        result['numpy'] = measure(make_table(args.rooms, args.members, now), now, args.repeat)
+    numpy, drift.np = drift.np, None
+    random.seed(0)
+    result['python'] = measure(make_table(args.rooms, args.members, now), now, args.repeat)
+    drift.np = numpy
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# 登录风暴基准测试：在eventlet下并发登录的同时测量socket事件延迟
+# 用法: python bench/login_storm.py [--mode pool|inline] [--logins 200] [--concurrency 20]
+# --mode inline 在事件循环中直接计算密码散列，用于和线程池方式对比
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=('pool', 'inline'), default='pool')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--probe-interval', type=float, default=0.005)
+    args = parser.parse_args()
+
+    from app import create_app
+    from extensions import socketio
+    from models import db
+
+    app = create_app()
+    import models
+
+    if args.mode == 'inline':
+        models.password_pool.run = lambda func, *a: func(*a)
+
+    with app.app_context():
+        db.create_all()
+
+    http = app.test_client()
+    http.post('/sign-up', json={'account': 'probe@bench', 'password': 'pw', 'nickname': 'probe'})
+    http.post('/create-room', json={'tabId': '1', 'roomNumber': 'bench', 'roomUrl': 'http://bench'})
+    probe = socketio.test_client(app, namespace='/room', flask_test_client=http)
+    for i in range(args.concurrency):
+        app.test_client().post('/sign-up', json={'account': 'u%d@bench' % i, 'password': 'pw', 'nickname': 'u%d' % i})
+
+    latencies = []
+    running = [True]
+
+    def probe_loop():
+        # 每次探测包含一次socket事件处理和一次调度等待，事件循环被阻塞时延迟会明显升高
+        while running[0]:
+            start = time.perf_counter()
+            eventlet.sleep(args.probe_interval)
+            probe.emit('resync', namespace='/room')
+            probe.get_received('/room')
+            latencies.append((time.perf_counter() - start - args.probe_interval) * 1000)
+
+    status = {}
+
+    def login(i):
+        client = app.test_client()
+        rsp = client.post('/sign-in', json={'account': 'u%d@bench' % (i % args.concurrency), 'password': 'pw'})
+        status[rsp.status_code] = status.get(rsp.status_code, 0) + 1
+
+    prober = eventlet.spawn(probe_loop)
+    eventlet.sleep(0.2)
+    idle = list(latencies)
+    del latencies[:]
+
+    start = time.perf_counter()
+    pool = eventlet.GreenPool(args.concurrency)
+    for i in range(args.logins):
+        pool.spawn_n(login, i)
+    pool.waitall()
+    elapsed = time.perf_counter() - start
+
+    running[0] = False
+    prober.wait()
+
+    print(json.dumps({
+        'mode': args.mode,
+        'logins': args.logins,
+        'concurrency': args.concurrency,
+        'logins_per_sec': round(args.logins / elapsed, 1),
+        'status': status,
+        'password_pool_rejected': models.password_pool.rejected,
+        'idle_latency_ms': {'p50': round(percentile(idle, 50), 3), 'p99': round(percentile(idle, 99), 3)},
+        'storm_latency_ms': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(max(latencies or [0]), 3),
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# 房间同步负载测试：在进程内启动应用，用N个模拟socket.io客户端分布在M个房间中，
+# 走真实的 /create-room、/join-room、updateInfo 和 sync 流程，输出JSON格式结果便于不同提交之间对比
+# 用法: python bench/room_sync.py [--clients 100] [--rooms 10] [--rounds 50] [--sync-every 10] [--output result.json]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+
+def summary(values):
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 50), 3),
+        'p95': round(percentile(values, 95), 3),
+        'p99': round(percentile(values, 99), 3),
+        'max': round(max(values or [0]), 3),
+    }
+
+
+class SimClient:
+    def __init__(self, app, socketio, index: int, room_number: str, owner: bool):
+        self.email = 'bench%d@bench' % index
+        self.room_number = room_number
+        self.http = app.test_client()
+        self.http.post('/sign-up', json={'account': self.email, 'password': 'pw', 'nickname': 'bench%d' % index})
+        if owner:
+            self.http.post('/create-room', json={'tabId': str(index), 'roomNumber': room_number,
+                                                 'roomUrl': 'https://example.com/%s' % room_number})
+        else:
+            self.http.post('/join-room', json={'tabId': str(index), 'roomNumber': room_number})
+        self.socket = socketio.test_client(app, namespace='/room', flask_test_client=self.http)
+        self.received = 0
+
+    def emit(self, event: str, data: dict):
+        self.socket.emit(event, data, namespace='/room')
+
+    def drain(self) -> list:
+        messages = self.socket.get_received('/room')
+        self.received += len(messages)
+        return messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--sync-every', type=int, default=10, help='每隔多少轮在每个房间发起一次sync')
+    parser.add_argument('--output', help='结果写入文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    from app import create_app
+    from extensions import socketio
+    from models import db
+
+    app = create_app()
+    from sync import RoomFlusher
+
+    with app.app_context():
+        db.create_all()
+
+    setup_start = time.perf_counter()
+    rooms: dict[str, list[SimClient]] = {}
+    for i in range(args.clients):
+        room_number = 'bench-%d' % (i % args.rooms)
+        members = rooms.setdefault(room_number, [])
+        members.append(SimClient(app, socketio, i, room_number, owner=not members))
+    clients = [c for members in rooms.values() for c in members]
+    for client in clients:
+        client.drain()
+        client.received = 0
+    setup_seconds = time.perf_counter() - setup_start
+
+    flusher = RoomFlusher()
+    inbound = 0
+    sync_latencies = []
+    start = time.perf_counter()
+    for round_index in range(args.rounds):
+        # 每个客户端上报一次进度和状态，随后模拟一次定时合并广播
+        for client in clients:
+            client.emit('updateInfo', {'currentProgress': round_index + 1, 'currentState': 'onplaying'})
+            inbound += 1
+        flusher.flush()
+
+        if args.sync_every and round_index % args.sync_every == 0:
+            for members in rooms.values():
+                # 从房主发起sync/init到所有成员收到play指令的耗时
+                sync_start = time.perf_counter()
+                members[0].emit('sync', {'action': 'init', 'time': round_index})
+                inbound += 1
+                generation = None
+                for member in members:
+                    for message in member.drain():
+                        if message['name'] == 'videoAction' and message['args'][0].get('action') == 'pause':
+                            generation = message['args'][0].get('generation')
+                for member in members:
+                    member.emit('sync', {'action': 'updateState', 'state': 1, 'generation': generation})
+                    inbound += 1
+                played = 0
+                for member in members:
+                    played += sum(1 for message in member.drain() if message['name'] == 'videoAction'
+                                  and message['args'][0].get('action') == 'play')
+                if played == len(members):
+                    sync_latencies.append((time.perf_counter() - sync_start) * 1000)
+
+        for client in clients:
+            client.drain()
+    elapsed = time.perf_counter() - start
+    outbound = sum(c.received for c in clients)
+
+    result = {
+        'clients': args.clients,
+        'rooms': args.rooms,
+        'rounds': args.rounds,
+        'setup_seconds': round(setup_seconds, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'inbound_events': inbound,
+        'events_per_sec': round(inbound / elapsed, 1),
+        'outbound_messages': outbound,
+        'outbound_per_inbound': round(outbound / inbound, 3),
+        'sync_to_play_ms': summary(sync_latencies),
+    }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
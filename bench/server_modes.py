@@ -0,0 +1,177 @@
+# 服务模式对比基准测试：分别以green thread模式（socketio.run + eventlet）和asyncio模式（asgi.py + uvicorn）
+# 在子进程中启动服务，用真实的HTTP和websocket客户端测量resync往返延迟、吞吐量和/profile延迟，输出JSON格式结果
+# 客户端依赖 requests 和 websocket-client
+# 用法: python bench/server_modes.py [--modes green,asyncio] [--clients 50] [--rooms 5] [--requests 50] [--output result.json]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+
+def summary(values):
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 50), 3),
+        'p95': round(percentile(values, 95), 3),
+        'p99': round(percentile(values, 99), 3),
+        'max': round(max(values or [0]), 3),
+    }
+
+
+def serve(mode: str, port: int):
+    # 在子进程中运行，不使用证书
+    if mode == 'green':
+        import eventlet
+        eventlet.monkey_patch()
+        from app import create_app
+        from extensions import socketio
+        from models import db
+        app = create_app()
+        with app.app_context():
+            db.create_all()
+        socketio.run(app, host='127.0.0.1', port=port, log_output=False)
+    else:
+        import uvicorn
+        from asgi import app, application
+        from models import db
+        with app.app_context():
+            db.create_all()
+        uvicorn.run(application, host='127.0.0.1', port=port, log_level='warning')
+
+
+class BenchClient:
+    def __init__(self, base_url: str, index: int, room_number: str, owner: bool):
+        import requests
+        import socketio as python_socketio
+
+        self.base_url = base_url
+        self.http = requests.Session()
+        email = 'bench%d@bench' % index
+        self.http.post(base_url + '/sign-up', json={'account': email, 'password': 'pw', 'nickname': 'bench%d' % index})
+        if owner:
+            self.http.post(base_url + '/create-room', json={'tabId': str(index), 'roomNumber': room_number,
+                                                           'roomUrl': 'https://example.com/%s' % room_number})
+        else:
+            self.http.post(base_url + '/join-room', json={'tabId': str(index), 'roomNumber': room_number})
+
+        self.panel = threading.Event()
+        self.socket = python_socketio.Client()
+        self.socket.on('room-panel', lambda data: self.panel.set(), namespace='/room')
+        cookie = '; '.join('%s=%s' % (c.name, c.value) for c in self.http.cookies)
+        self.socket.connect(base_url, headers={'Cookie': cookie}, namespaces=['/room'], transports=['websocket'])
+        self.panel.wait(5)
+
+    def resync(self) -> float:
+        # 请求完整快照并等待room-panel，返回往返毫秒数
+        self.panel.clear()
+        start = time.perf_counter()
+        self.socket.emit('resync', namespace='/room')
+        if not self.panel.wait(5):
+            return None
+        return (time.perf_counter() - start) * 1000
+
+    def profile(self) -> float:
+        start = time.perf_counter()
+        self.http.get(self.base_url + '/profile')
+        return (time.perf_counter() - start) * 1000
+
+    def close(self):
+        self.socket.disconnect()
+
+
+def run_mode(mode: str, args) -> dict:
+    port = args.port
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'),
+               LOG_LEVEL='WARNING', CLOCK_PING_INTERVAL='0')
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, '--port', str(port)],
+                              env=env, cwd=ROOT)
+    base_url = 'http://127.0.0.1:%d' % port
+    try:
+        import requests
+        start = time.perf_counter()
+        while True:
+            try:
+                requests.get(base_url + '/profile', timeout=1)
+                break
+            except requests.ConnectionError:
+                if time.perf_counter() - start > 30:
+                    raise RuntimeError('%s server did not start' % mode)
+                time.sleep(0.2)
+        startup_seconds = time.perf_counter() - start
+
+        clients = [BenchClient(base_url, i, 'bench-%d' % (i % args.rooms), owner=i < args.rooms)
+                   for i in range(args.clients)]
+
+        resync_latencies, profile_latencies, failures = [], [], []
+
+        def worker(client):
+            for _ in range(args.requests):
+                latency = client.resync()
+                if latency is None:
+                    failures.append(1)
+                else:
+                    resync_latencies.append(latency)
+            for _ in range(args.requests // 5 or 1):
+                profile_latencies.append(client.profile())
+
+        threads = [threading.Thread(target=worker, args=(c,)) for c in clients]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        for client in clients:
+            client.close()
+        return {
+            'mode': mode,
+            'startup_seconds': round(startup_seconds, 3),
+            'elapsed_seconds': round(elapsed, 3),
+            'resync_per_sec': round(len(resync_latencies) / elapsed, 1),
+            'resync_failures': len(failures),
+            'resync_rtt_ms': summary(resync_latencies),
+            'profile_ms': summary(profile_latencies),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', default='green,asyncio')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=50, help='每个客户端发送的resync次数')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--serve', choices=('green', 'asyncio'), help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='结果写入文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    results = [run_mode(mode, args) for mode in args.modes.split(',')]
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
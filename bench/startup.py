@@ -0,0 +1,75 @@
+# 启动耗时基准测试：对每组组件在全新子进程中执行 create_app(components=...)，测量导入和初始化耗时、
+# 进程总耗时和导入的模块数，多次取中位数，输出JSON格式结果
+# 用法: python bench/startup.py [--profiles full,auth,monitor,socketio,bare] [--repeat 5] [--output result.json]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROFILES = {
+    'full': ('auth', 'logit', 'monitor', 'socketio'),
+    'auth': ('auth',),
+    'monitor': ('monitor',),
+    'socketio': ('socketio',),
+    'bare': (),
+}
+
+# 在子进程中执行，输出 [导入耗时, 初始化耗时, 模块数]
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app(components=%r)
+print(json.dumps([imported - start, time.perf_counter() - imported, len(sys.modules)]))
+'''
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(components, repeat: int) -> dict:
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'),
+               LOG_LEVEL='WARNING')
+    imports, inits, totals, modules = [], [], [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', PROBE % (components,)], env=env, cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout
+        totals.append(time.perf_counter() - start)
+        imported, initialized, modules = json.loads(output.strip().splitlines()[-1])
+        imports.append(imported)
+        inits.append(initialized)
+    return {
+        'components': list(components),
+        'import_ms': round(median(imports) * 1000, 1),
+        'create_app_ms': round(median(inits) * 1000, 1),
+        'process_ms': round(median(totals) * 1000, 1),
+        'modules': modules,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', default=','.join(PROFILES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='结果写入文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    results = {name: measure(PROFILES[name], args.repeat) for name in args.profiles.split(',')}
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
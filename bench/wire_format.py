@@ -0,0 +1,67 @@
+# socket消息编码基准测试：对比不同房间人数下JSON和msgpack的每次广播字节数与编码耗时
+# 用法: python bench/wire_format.py [--sizes 2,10,50,200] [--repeat 2000]
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def build_room(size: int):
+    from sync import Room, User
+
+    room = Room('123456', 'https://www.bilibili.com/video/BV1xx411c7mD')
+    room.video_identify = 'BV1xx411c7mD'
+    room.version = 1024
+    for i in range(size):
+        user = User('user%d@example.com' % i, 'nickname%d' % i, str(100000 + i))
+        user.socketio = True
+        user.video_state = 'onplaying'
+        user.video_progress = 1234.5 + i
+        user.rtt = 40 + i % 50
+        user.clock_offset = -15 + i % 30
+        room.users[user.email] = user
+    return room
+
+
+def measure(data, codec: str, repeat: int):
+    import wire
+
+    if codec == wire.JSON:
+        # socket.io对JSON参数使用紧凑分隔符序列化
+        encode = lambda: json.dumps(data, separators=(',', ':')).encode()
+    else:
+        encode = lambda: wire.encode(data, codec)
+    size = len(encode())
+    seconds = timeit.timeit(encode, number=repeat)
+    return {'bytes': size, 'encode_us': round(seconds / repeat * 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='2,10,50,200')
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    import wire
+
+    results = []
+    for size in [int(n) for n in args.sizes.split(',')]:
+        room = build_room(size)
+        snapshot = room.get_room_info()
+        # 一次典型的进度合并广播：房间内所有成员的进度同时变化
+        patch = {'version': room.version + 1,
+                 'users': {email: {'video_progress': user.video_progress + 0.5} for email, user in room.users.items()}}
+        row = {'room_size': size}
+        for name, data in (('snapshot', snapshot), ('patch', patch)):
+            for codec in (wire.JSON, wire.MSGPACK):
+                row['%s_%s' % (name, codec)] = measure(data, codec, args.repeat)
+        results.append(row)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import gzip
+import hashlib
+
+from flask import current_app, render_template, request
+from werkzeug import http
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # 未安装brotli时只使用gzip
+    brotli = None
+
+
+# 按Accept-Encoding压缩的响应类型
+MIMETYPES = ('application/json', 'text/html')
+
+
+def encodings() -> list:
+    # 服务端支持的压缩编码，质量相同时优先br
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def negotiate():
+    # 返回客户端接受的最佳编码，不接受压缩时返回None
+    return request.accept_encodings.best_match(encodings())
+
+
+def compress(data: bytes, encoding: str, level: int = None) -> bytes:
+    # level为空时使用按请求压缩的级别，静态页面只压缩一次，使用最高级别
+    if encoding == 'br':
+        quality = current_app.config['COMPRESS_BR_QUALITY'] if level is None else level
+        return brotli.compress(data, quality=quality)
+    level = current_app.config['COMPRESS_GZIP_LEVEL'] if level is None else level
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def init_app(app):
+    app.after_request(compress_response)
+
+
+def compress_response(response):
+    # 不小于COMPRESS_MIN_SIZE字节的JSON和HTML响应按Accept-Encoding压缩，已压缩或流式响应不处理
+    if (not 200 <= response.status_code < 300 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    compressed = compress(data, encoding)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # 压缩后的字节与原ETag对应的内容不同，改为弱ETag，If-None-Match按弱比较仍能命中
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    metrics.http_response_bytes.inc(encoding, 'raw', amount=len(data))
+    metrics.http_response_bytes.inc(encoding, 'sent', amount=len(compressed))
+    return response
+
+
+class StaticPage:
+    # 不随用户变化的页面，启动时渲染一次并预先压缩为各编码，响应带长期缓存头和ETag，不再每次请求渲染模板
+    # 各编码的响应头也预先生成，请求时只需协商编码和比较ETag
+    def __init__(self, template: str):
+        self.template = template
+        body = render_template(template).encode()
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+        self.variants = {None: body}
+        for encoding in encodings():
+            self.variants[encoding] = compress(body, encoding, level=11 if encoding == 'br' else 9)
+
+        cache_control = 'public, max-age=%d' % current_app.config['STATIC_PAGE_MAX_AGE']
+        self.headers = {}
+        for encoding in self.variants:
+            headers = [('Content-Type', 'text/html; charset=utf-8'), ('Vary', 'Accept-Encoding'),
+                       ('Cache-Control', cache_control), ('ETag', http.quote_etag(self.etag, encoding is not None))]
+            if encoding is not None:
+                headers.append(('Content-Encoding', encoding))
+            self.headers[encoding] = headers
+
+    def response(self):
+        encoding = negotiate()
+        if request.if_none_match.contains_weak(self.etag):
+            return current_app.response_class(status=304, headers=self.headers[encoding][1:])
+        return current_app.response_class(self.variants[encoding], headers=self.headers[encoding])
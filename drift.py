@@ -0,0 +1,147 @@
+_UNLOADED = object()
+np = _UNLOADED  # 首次计算时才导入numpy，不增加进程启动时间
+
+
+def load_numpy():
+    # 返回numpy模块，未安装时返回None，逐个成员计算
+    global np
+    if np is _UNLOADED:
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+    return np
+
+
+# 每个成员的纠正动作
+NONE = 0
+RATE = 1  # 调整播放速率，在若干秒内逐渐追上
+SEEK = 2  # 偏差过大，直接跳转
+RESET = 3  # 偏差已回到容差内，恢复正常速率
+
+
+def detect(reference, reference_at, progress, progress_at, rate, now: int, tolerance: float, seek_threshold: float,
+           window: float, max_rate_adjust: float):
+    # 一次计算所有房间所有成员相对房间权威播放位置的偏差，参数为等长序列（每个成员一项）：
+    # reference/reference_at 成员所在房间的播放位置（秒）及其服务端时间（毫秒），progress/progress_at 成员上报的进度及上报时间，
+    # rate 成员当前被设置的播放速率；返回 (房间当前位置, 偏差秒数, 动作, 目标速率)，偏差为正表示成员超前
+    if load_numpy() is None:
+        return _detect_python(reference, reference_at, progress, progress_at, rate, now, tolerance, seek_threshold,
+                              window, max_rate_adjust)
+
+    reference = np.asarray(reference, dtype=float) + (now - np.asarray(reference_at, dtype=float)) / 1000
+    rate = np.asarray(rate, dtype=float)
+    position = np.asarray(progress, dtype=float) + (now - np.asarray(progress_at, dtype=float)) / 1000 * rate
+    drift = position - reference
+    magnitude = np.abs(drift)
+    target = np.clip(1 - drift / window, 1 - max_rate_adjust, 1 + max_rate_adjust)
+    action = np.where(magnitude > seek_threshold, SEEK,
+                      np.where(magnitude > tolerance, np.where(np.abs(target - rate) > 0.005, RATE, NONE),
+                               np.where(rate != 1, RESET, NONE)))
+    return reference, drift, action, target
+
+
+def _detect_python(reference, reference_at, progress, progress_at, rate, now, tolerance, seek_threshold, window,
+                   max_rate_adjust):
+    references, drifts, actions, targets = [], [], [], []
+    for ref, ref_at, pos, pos_at, r in zip(reference, reference_at, progress, progress_at, rate):
+        ref = ref + (now - ref_at) / 1000
+        drift = pos + (now - pos_at) / 1000 * r - ref
+        target = min(max(1 - drift / window, 1 - max_rate_adjust), 1 + max_rate_adjust)
+        if abs(drift) > seek_threshold:
+            action = SEEK
+        elif abs(drift) > tolerance:
+            action = RATE if abs(target - r) > 0.005 else NONE
+        else:
+            action = RESET if r != 1 else NONE
+        references.append(ref)
+        drifts.append(drift)
+        actions.append(action)
+        targets.append(target)
+    return references, drifts, actions, targets
+
+
+def corrections(action) -> list:
+    # 需要纠正的成员下标
+    if load_numpy() is not None and isinstance(action, np.ndarray):
+        return np.flatnonzero(action).tolist()
+    return [i for i, a in enumerate(action) if a]
+
+
+class MemberTable:
+    # 参与偏差计算的连接按行保存为列（numpy数组，未安装numpy时为list），成员上报、播放状态变化和连接增减时只更新对应行，
+    # 定时检查时不再遍历所有连接，直接按列筛选；删除的行放入空闲列表复用，行数不足时容量翻倍
+    # playing 为1表示房间正在播放且成员已连接、正在播放并上报过进度
+    columns = ('reference', 'reference_at', 'progress', 'progress_at', 'rate', 'corrected_at', 'playing')
+
+    def __init__(self, capacity: int = 1024):
+        self.rows: dict = {}  # key -> 行号
+        self._free: list[int] = []
+        self._size = 0  # 已分配的行数（包括空闲行）
+        self._np = load_numpy()
+        self.keys = self._alloc(capacity, object)
+        self.data: dict = {name: self._alloc(capacity, float) for name in self.columns}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _alloc(self, capacity: int, dtype):
+        if self._np is None:
+            return [None if dtype is object else 0.0] * capacity
+        return self._np.empty(capacity, dtype=object) if dtype is object else self._np.zeros(capacity)
+
+    def _grow(self):
+        capacity = len(self.keys) * 2
+        for name in ('keys',) + self.columns:
+            old = self.keys if name == 'keys' else self.data[name]
+            new = self._alloc(capacity, object if name == 'keys' else float)
+            new[:len(old)] = old
+            if name == 'keys':
+                self.keys = new
+            else:
+                self.data[name] = new
+
+    def add(self, key, **values):
+        row = self.rows.get(key)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                if self._size == len(self.keys):
+                    self._grow()
+                row = self._size
+                self._size += 1
+            self.rows[key] = row
+            self.keys[row] = key
+            for name in self.columns:
+                self.data[name][row] = 0
+            self.data['rate'][row] = 1
+        self.update(key, **values)
+
+    def update(self, key, **values):
+        row = self.rows.get(key)
+        if row is not None:
+            for name, value in values.items():
+                self.data[name][row] = value
+
+    def remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.keys[row] = None
+            self.data['playing'][row] = 0
+            self._free.append(row)
+
+    def select(self, now: int, max_age: int):
+        # 返回参与计算的行的 (key序列, (reference, reference_at, progress, progress_at, rate))：
+        # playing为1、进度上报晚于上次纠正且距今不超过max_age毫秒
+        n = self._size
+        data = self.data
+        if self._np is None:
+            rows = [i for i in range(n) if data['playing'][i] and data['progress_at'][i] >= data['corrected_at'][i]
+                    and now - data['progress_at'][i] <= max_age]
+            return [self.keys[i] for i in rows], tuple([data[name][i] for i in rows] for name in self.columns[:5])
+
+        progress_at = data['progress_at'][:n]
+        mask = (data['playing'][:n] != 0) & (progress_at >= data['corrected_at'][:n]) & (now - progress_at <= max_age)
+        rows = self._np.flatnonzero(mask)
+        return self.keys[rows], tuple(data[name][rows] for name in self.columns[:5])
@@ -0,0 +1,22 @@
+# 各组件共用的扩展对象，在create_app中按需绑定到应用；模块只依赖这里而不依赖app，避免循环导入
+from flask import current_app
+from flask_login import LoginManager
+from flask_socketio import SocketIO
+
+
+socketio = SocketIO()
+socketio_namespace = '/room'
+
+# 用户登录
+login_manager = LoginManager()
+login_manager.login_view = 'auth.sign_in'
+
+
+def start_background_task(target, *args):
+    # 后台任务没有应用上下文，在创建任务时所在应用的上下文中执行，任务中可以使用current_app
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            target(*args)
+    return socketio.start_background_task(run)
@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+
+class RoomJournal:
+    # 房间状态的追加日志和定期压缩快照，进程重启后回放以恢复房间
+    # 日志每行一条记录：{'seq', 'op': 'room' | 'patch' | 'delete', ...}，快照记录压缩时最后一条日志的seq
+    # 锁顺序：房间锁 -> 日志锁。修改房间时持有房间锁追加日志，所以持有日志锁时不能读取房间状态（Room.to_state取房间锁）
+    def __init__(self, directory: str, compact_every: int = 10000, compact_interval: float = 300):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self.compacted_at = time.monotonic()
+        self.snapshot_path = os.path.join(directory, 'rooms.snapshot.json')
+        self.journal_path = os.path.join(directory, 'rooms.journal')
+        self.rotated_path = self.journal_path + '.old'  # 压缩过程中换下的日志，快照写完后删除
+        self.compacting = False
+        self.seq = 0
+        self.entries = 0  # 上次压缩后追加的记录数
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        # 读取快照并回放之后的日志，返回 room number -> room state
+        os.makedirs(self.directory, exist_ok=True)
+        rooms = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self.seq = snapshot['seq']
+            rooms = {state['room_number']: state for state in snapshot['rooms']}
+
+        # 压缩未完成时进程退出会留下换下的旧日志，先回放旧日志再回放当前日志
+        for path in (self.rotated_path, self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # 进程崩溃时最后一行可能只写了一半
+                    if entry['seq'] <= self.seq:
+                        continue
+                    self.seq = entry['seq']
+                    self.entries += 1
+                    self._replay(rooms, entry)
+        return rooms
+
+    @staticmethod
+    def _replay(rooms: dict, entry: dict):
+        op = entry['op']
+        if op == 'room':
+            rooms[entry['state']['room_number']] = entry['state']
+        elif op == 'delete':
+            rooms.pop(entry['room_number'], None)
+        elif op == 'patch' and entry['room_number'] in rooms:
+            state = rooms[entry['room_number']]
+            patch = entry['patch']
+            state['version'] = patch['version']
+            state.update(patch.get('room', {}))
+            for email, fields in patch.get('users', {}).items():
+                if fields is None:
+                    state['users'].pop(email, None)
+                elif 'email' in fields:
+                    state['users'][email] = fields
+                elif email in state['users']:
+                    state['users'][email].update(fields)
+
+    def _append(self, entry: dict):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.journal_path, 'a', encoding='utf-8')
+            self.seq += 1
+            entry['seq'] = self.seq
+            self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self._file.flush()
+            self.entries += 1
+
+    def compact_due(self) -> bool:
+        # 日志记录数或距上次压缩的时间超过阈值且没有正在进行的压缩时返回True，并由调用方负责执行compact
+        with self._lock:
+            if self.compacting or not self.entries:
+                return False
+            if self.entries < self.compact_every and time.monotonic() - self.compacted_at < self.compact_interval:
+                return False
+            self.compacting = True
+            return True
+
+    def record_room(self, room):
+        self._append({'op': 'room', 'state': room.to_state()})
+
+    def record_patch(self, room_number: str, patch: dict):
+        self._append({'op': 'patch', 'room_number': room_number, 'patch': patch})
+
+    def record_delete(self, room_number: str):
+        self._append({'op': 'delete', 'room_number': room_number})
+
+    def compact(self, rooms):
+        # 先在日志锁内换下当前日志并记下seq，之后的记录写入新日志；再不持有日志锁读取房间状态写快照，
+        # 快照中已包含seq之后的部分修改时，回放这些记录得到的结果相同；快照先写临时文件再原子替换，最后删除旧日志
+        with self._lock:
+            self.compacting = True
+            seq = self.seq
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.journal_path):
+                if os.path.exists(self.rotated_path):
+                    # 上次压缩未完成，合并到旧日志中
+                    with open(self.rotated_path, 'a', encoding='utf-8') as dst, \
+                            open(self.journal_path, encoding='utf-8') as src:
+                        dst.write('\n')
+                        shutil.copyfileobj(src, dst)
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, self.rotated_path)
+            self.entries = 0
+            self.compacted_at = time.monotonic()
+
+        try:
+            states = [room.to_state() for room in list(rooms)]
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'seq': seq, 'time': time.time(), 'rooms': states}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            if os.path.exists(self.rotated_path):
+                os.remove(self.rotated_path)
+        finally:
+            self.compacting = False
@@ -0,0 +1,74 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+
+class LazyJson:
+    # 日志参数，只有日志真正输出时才序列化
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        try:
+            return json.dumps(self.obj, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            return repr(self.obj)
+
+
+class LazyQueueHandler(QueueHandler):
+    # 标准QueueHandler入队前会在调用线程中格式化消息，这里直接入队，格式化交给后台监听线程
+    def prepare(self, record):
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    # 按事件类型采样：携带 extra={'event': name} 的INFO及以下日志每rates[name]条只保留1条，WARNING及以上总是保留
+    # 同一事件处理中常有多条日志，按(事件, 消息模板)分别计数，避免同一事件的各条日志轮流占用计数而永远不被输出
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self._counts: dict[tuple, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record) -> bool:
+        event = getattr(record, 'event', None)
+        rate = self.rates.get(event, 1)
+        if rate <= 1 or record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            key = (event, record.msg)
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % rate == 0
+
+
+def parse_sample_rates(value: str) -> dict:
+    # "updateInfo=100,clockPong=100" -> {'updateInfo': 100, 'clockPong': 100}
+    rates = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        event, _, rate = item.partition('=')
+        rates[event.strip()] = max(int(rate or 1), 1)
+    return rates
+
+
+def setup_logging(logger: logging.Logger, level: str, sample_rates: dict) -> QueueListener:
+    # 将logger原有的handler移到后台QueueListener中执行，调用方只做入队
+    handlers = list(logger.handlers) or [logging.StreamHandler()]
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rates))
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,171 @@
+import bisect
+import functools
+import threading
+import time
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(pairs)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.documentation)
+        yield '# TYPE %s counter' % self.name
+        for label_values, value in sorted(self._values.items()):
+            yield '%s%s %s' % (self.name, _format_labels(self.labels, label_values), value)
+
+
+class Gauge:
+    # callback不为空时在抓取时调用它获取当前值，返回数值或 {label values: value}
+    def __init__(self, name: str, documentation: str, labels=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value: float):
+        with self._lock:
+            self._values[label_values] = value
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        values = self._values
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+        yield '# HELP %s %s' % (self.name, self.documentation)
+        yield '# TYPE %s gauge' % self.name
+        for label_values, value in sorted(values.items()):
+            yield '%s%s %s' % (self.name, _format_labels(self.labels, label_values), value)
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values: dict[tuple, list] = {}  # label values -> [各区间计数..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(label_values)
+            if data is None:
+                data = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def time(self, *label_values):
+        # 装饰器，记录函数执行耗时（秒）
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *label_values)
+            return wrapper
+        return decorator
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.documentation)
+        yield '# TYPE %s histogram' % self.name
+        names = self.labels + ('le',)
+        for label_values, data in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), data):
+                cumulative += count
+                yield '%s_bucket%s %s' % (self.name, _format_labels(names, label_values + (bound,)), cumulative)
+            labels = _format_labels(self.labels, label_values)
+            yield '%s_sum%s %s' % (self.name, labels, data[-2])
+            yield '%s_count%s %s' % (self.name, labels, data[-1])
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# 进程内全局指标，/metrics 以Prometheus文本格式输出
+registry = Registry()
+
+http_request_seconds = registry.register(Histogram(
+    'watch_together_http_request_seconds', 'HTTP request latency in seconds', ('endpoint', 'method', 'status')))
+socket_event_seconds = registry.register(Histogram(
+    'watch_together_socket_event_seconds', 'Socket.IO event handler latency in seconds', ('event',)))
+emitted_messages = registry.register(Counter(
+    'watch_together_emitted_messages_total', 'Socket.IO emit calls by event type', ('event',)))
+emitted_recipients = registry.register(Counter(
+    'watch_together_emitted_recipients_total', 'Messages delivered to members by event type', ('event',)))
+emitted_bytes = registry.register(Counter(
+    'watch_together_emitted_bytes_total', 'Encoded payload bytes emitted by event type', ('event',)))
+connected_sockets = registry.register(Gauge(
+    'watch_together_connected_sockets', 'Sockets connected to the /room namespace'))
+sync_barrier_wait_seconds = registry.register(Histogram(
+    'watch_together_sync_barrier_wait_seconds', 'Time from sync init to play order in seconds', ('outcome',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30)))
+conflated_messages = registry.register(Counter(
+    'watch_together_conflated_messages_total', 'Stale room state messages replaced before reaching a slow socket',
+    ('event',)))
+slow_disconnects = registry.register(Counter(
+    'watch_together_slow_disconnects_total', 'Sockets disconnected for staying behind the outbound backlog limit'))
+drift_corrections = registry.register(Counter(
+    'watch_together_drift_corrections_total', 'Targeted videoAction corrections sent to drifting members', ('action',)))
+drift_check_seconds = registry.register(Histogram(
+    'watch_together_drift_check_seconds', 'Time spent computing drift across all rooms in seconds'))
+http_response_bytes = registry.register(Counter(
+    'watch_together_http_response_bytes_total', 'Compressed HTTP response body bytes before and after compression',
+    ('encoding', 'stage')))
+reaped = registry.register(Counter(
+    'watch_together_reaped_total', 'Disconnected members evicted and empty rooms deleted by the reaper', ('kind',)))
+
+
+def track_event(event: str):
+    # socket事件处理耗时
+    return socket_event_seconds.time(event)
@@ -1,18 +1,97 @@
+import sqlite3
+
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
+from flask import current_app
+from flask.cli import with_appcontext
 from flask_login import UserMixin
-from app import db
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 from sqlalchemy_serializer import SerializerMixin
+from extensions import socketio
+from utils import LRUCache, NativePool
+
+
+# 数据库
+db = SQLAlchemy()
+
+# user_loader使用的用户缓存，避免每个请求和socket事件都查询数据库，容量和过期时间在init_app中按配置设置
+user_cache = LRUCache()
+
+# 密码散列线程池，散列计算不阻塞socket事件循环
+password_pool = NativePool()
+
+
+def init_app(app):
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # SQLite使用连接池复用连接，连接可跨线程归还
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+            'poolclass': QueuePool,
+            'pool_size': app.config['DATABASE_POOL_SIZE'],
+            'max_overflow': app.config['DATABASE_POOL_OVERFLOW'],
+            'connect_args': {'check_same_thread': False, 'timeout': 5},
+        })
+    db.init_app(app)
+    app.cli.add_command(migrate_db_command)
+    user_cache.maxsize = app.config['USER_CACHE_SIZE']
+    user_cache.ttl = app.config['USER_CACHE_TTL']
+    # 未启用websocket时使用原生线程池
+    async_mode = socketio.async_mode if socketio.server else None
+    password_pool.configure(async_mode, app.config['PASSWORD_POOL_SIZE'], app.config['PASSWORD_POOL_PENDING'])
+
+
+# SQLite开启WAL模式，读写互不阻塞
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=5000')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
 
 
 class User(db.Model, UserMixin, SerializerMixin):
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(64))
+    email = db.Column(db.String(64), unique=True, index=True)  # 账号，唯一索引
     nickname = db.Column(db.String(64))         # 用户名
     password_hash = db.Column(db.String(128))   # 密码散列值
 
     def set_password(self, password):           # 用来设置密码的方法，接受密码作为参数
-        self.password_hash = generate_password_hash(password)  # 将生成的密码保持到对应字段
+        self.password_hash = password_pool.run(generate_password_hash, password)  # 将生成的密码保持到对应字段
 
     def validate_password(self, password):      # 用于验证密码的方法，接受密码作为参数
-        return check_password_hash(self.password_hash, password)  # 返回布尔值
+        return password_pool.run(check_password_hash, self.password_hash, password)  # 返回布尔值
+
+
+# 用户信息修改或删除后使缓存失效
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user_cache(mapper, connection, target):
+    user_cache.invalidate(str(target.id))
+
+
+def migrate_db():
+    # 创建缺失的表，并为已有data.db中的user.email补建唯一索引；存在重复账号时不建索引，需人工处理
+    db.create_all()
+    duplicates = db.session.execute(
+        text('SELECT email, COUNT(*) FROM user GROUP BY email HAVING COUNT(*) > 1')).fetchall()
+    if duplicates:
+        current_app.logger.error('duplicate user emails, unique index not created: %s'
+                                 % ', '.join(str(row[0]) for row in duplicates))
+        return False
+
+    db.session.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email ON user (email)'))
+    db.session.commit()
+    return True
+
 
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """创建数据表并补建索引"""
+    if migrate_db():
+        print('database migrated')
@@ -0,0 +1,97 @@
+import atexit
+import bisect
+import hashlib
+
+from flask import current_app
+
+from extensions import socketio, start_background_task
+
+
+class HashRing:
+    # 一致性哈希环，每个worker在环上放置replicas个虚拟节点，worker增减时只有相邻区间的房间需要迁移
+    def __init__(self, workers, replicas: int = 64):
+        self.workers = set(workers)
+        self.replicas = replicas
+        self._hashes: list[int] = []
+        self._nodes: list[str] = []
+
+        points = sorted((self._hash('%s#%d' % (worker, i)), worker) for worker in self.workers for i in range(replicas))
+        for point, worker in points:
+            self._hashes.append(point)
+            self._nodes.append(worker)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def get_worker(self, key: str):
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class ShardRouter:
+    # 按room_number将房间分配给worker进程，owner进程在内存中保留房间对象并处理该房间的全部事件
+    def __init__(self, store, worker_id: str, worker_url: str, replicas: int = 64, heartbeat: float = 5):
+        self.store = store
+        self.worker_id = worker_id
+        self.worker_url = worker_url
+        self.replicas = replicas
+        self.heartbeat = heartbeat
+        self.workers: dict[str, str] = {}  # worker id -> url
+        self.ring = HashRing((), replicas)
+        self._started = False
+        # 房间租约与worker心跳使用相同的有效期
+        store.worker_id = worker_id
+        store.lease_ttl = heartbeat * 3
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.worker_url)
+
+    def owner(self, room_number: str):
+        # 返回房间owner的(worker id, url)，未开启分片时总是当前进程
+        if not self.enabled:
+            return self.worker_id, self.worker_url
+        self.start()
+        worker_id = self.ring.get_worker(str(room_number)) or self.worker_id
+        return worker_id, self.workers.get(worker_id, self.worker_url)
+
+    def is_local(self, room_number: str) -> bool:
+        return self.owner(room_number)[0] == self.worker_id
+
+    def refresh(self):
+        # 上报心跳并重建哈希环；哈希环变化时内存中的房间全部写回共享存储、释放租约后移除，
+        # 新owner在下次访问时取得租约并从共享存储加载，避免使用变为owner之前缓存的旧状态
+        self.store.register_worker(self.worker_id, self.worker_url, self.heartbeat * 3)
+        workers = self.store.get_workers()
+        workers.setdefault(self.worker_id, self.worker_url)
+        if workers != self.workers:
+            self.workers = workers
+            self.ring = HashRing(workers.keys(), self.replicas)
+            self.store.release_rooms(self.store.cached_room_numbers())
+        self.store.owner_check = self.is_local
+        self.store.flush_rooms()
+        self.store.renew_leases()
+
+    def start(self):
+        if self._started or not self.enabled:
+            return
+        self._started = True
+        self.refresh()
+        atexit.register(self.stop)
+        start_background_task(self._run)
+
+    def stop(self):
+        # 进程退出前写回并释放全部房间，其余worker在下一次心跳时接管，无需等待租约过期
+        self.store.release_rooms(self.store.cached_room_numbers())
+        self.store.unregister_worker(self.worker_id)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.heartbeat)
+            try:
+                self.refresh()
+            except Exception as e:
+                current_app.logger.exception('shard refresh failed: %s', e)
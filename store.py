@@ -0,0 +1,322 @@
+import contextlib
+import json
+import threading
+import time
+
+
+class RoomOwnedElsewhere(Exception):
+    # 房间的租约由其他worker持有，本进程不能修改该房间
+    pass
+
+
+class MemoryStore:
+    # 进程内存储，房间只存在于当前进程，进程重启后丢失
+    def __init__(self, room_cls):
+        self.room_cls = room_cls
+        self.rooms: dict = {}  # room number -> room
+        self.user_to_room: dict[str, str] = {}  # email -> room number
+        self.workers: dict[str, str] = {}  # worker id -> url
+        self.owner_check = None
+        self.worker_id = None
+        self.lease_ttl = None
+        self._lock = threading.Lock()
+
+    def get_room(self, room_number: str):
+        return self.rooms.get(room_number)
+
+    # 索引的增删使用单个原子的dict操作（setdefault/pop）或持有索引锁，多线程并发时检查和修改不会交错
+    def add_room(self, room) -> bool:
+        return self.rooms.setdefault(room.room_number, room) is room
+
+    def delete_room(self, room_number: str) -> bool:
+        return self.rooms.pop(room_number, None) is not None
+
+    def get_user_room(self, email: str):
+        return self.user_to_room.get(email)
+
+    def set_user_room(self, email: str, room_number: str) -> bool:
+        with self._lock:
+            if email in self.user_to_room:
+                return False
+            self.user_to_room[email] = room_number
+            return True
+
+    def delete_user_room(self, email: str) -> bool:
+        return self.user_to_room.pop(email, None) is not None
+
+    @contextlib.contextmanager
+    def transaction(self, room):
+        # 单进程内房间对象即是唯一副本，无需加载和保存，只需持有房间锁
+        with room.lock:
+            yield room
+
+    def stats(self) -> dict:
+        return {'rooms': len(self.rooms), 'users': len(self.user_to_room)}
+
+    def register_worker(self, worker_id: str, url: str, ttl: float):
+        self.workers[worker_id] = url
+
+    def unregister_worker(self, worker_id: str):
+        self.workers.pop(worker_id, None)
+
+    def get_workers(self) -> dict:
+        return dict(self.workers)
+
+    def cached_room_numbers(self) -> list:
+        return []
+
+    def release_rooms(self, room_numbers):
+        pass
+
+    def flush_rooms(self, room_numbers=None):
+        pass
+
+    def renew_leases(self):
+        pass
+
+
+class RedisStore:
+    # 基于Redis协议的共享存储，多个worker进程通过它读写同一批房间
+    # client可以是redis.Redis，也可以是测试用的fakeredis.FakeRedis
+    def __init__(self, room_cls, client, prefix: str = 'watch-together', lock_timeout: float = 5):
+        self.room_cls = room_cls
+        self.client = client
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.rooms: dict = {}  # room number -> room，本进程使用过的房间对象
+        self.owner_check = None  # 分片模式下判断房间是否由本进程负责，由ShardRouter设置
+        self.worker_id = None  # 分片模式下租约的持有者标识和有效期（秒），由ShardRouter设置
+        self.lease_ttl = None
+        self.leases: dict[str, float] = {}  # room number -> 本进程持有的租约在本地可信任的截止时间（monotonic）
+        self.dirty: set[str] = set()  # 本进程负责且尚未写回Redis的房间
+        self._local = threading.local()  # 记录当前线程已持有锁的房间，transaction可重入
+
+    def _key(self, *parts: str) -> str:
+        return ':'.join((self.prefix,) + parts)
+
+    def _is_owned(self, room_number: str) -> bool:
+        # 本进程负责、持有租约且已在内存中的房间直接使用内存对象，不再访问Redis
+        if self.owner_check is None or room_number not in self.rooms or not self.owner_check(room_number):
+            return False
+        if self.leases.get(room_number, 0) > time.monotonic():
+            return True
+        # 本地信任期已过（续约被延迟）时同步续约，续约失败说明租约已被其他进程取得
+        return room_number in self.leases and bool(self._renew(room_number))
+
+    # 房间租约：分片模式下进程只有持有 owner:<room> 租约（SET NX PX）时才在内存中修改房间，
+    # 旧owner写回并释放租约（或租约过期）后新owner才能取得；写回时在WATCH下检查租约仍属于本进程，
+    # 租约已失去的进程不能用过期的内存状态覆盖新owner的修改
+    def _acquire(self, room_number: str) -> bool:
+        start = time.monotonic()
+        if not self.client.set(self._key('owner', room_number), self.worker_id, nx=True, px=int(self.lease_ttl * 1000)):
+            return False
+        # 本地只信任租约有效期的前一半，留出续约延迟和时钟误差的余量
+        self.leases[room_number] = start + self.lease_ttl / 2
+        return True
+
+    def _fenced(self, room_numbers, apply) -> list:
+        # 只对租约仍属于本进程的房间执行apply(pipe, room_number)，与检查在同一个事务中提交；
+        # 租约失去的房间丢弃本地未写回的修改，下次访问时从Redis重新加载
+        from redis.exceptions import WatchError
+
+        room_numbers = list(room_numbers)
+        keys = [self._key('owner', room_number) for room_number in room_numbers]
+        start = time.monotonic()
+        while True:
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(*keys)
+                    owners = pipe.mget(keys)
+                    held = [n for n, owner in zip(room_numbers, owners)
+                            if (owner.decode() if isinstance(owner, bytes) else owner) == self.worker_id]
+                    pipe.multi()
+                    for room_number in held:
+                        apply(pipe, room_number)
+                    pipe.execute()
+                    break
+                except WatchError:
+                    continue
+        for room_number in set(room_numbers).difference(held):
+            self.leases.pop(room_number, None)
+            self.dirty.discard(room_number)
+        for room_number in held:
+            if room_number in self.leases:
+                self.leases[room_number] = start + self.lease_ttl / 2
+        return held
+
+    def _renew(self, *room_numbers: str) -> list:
+        ttl = int(self.lease_ttl * 1000)
+        return self._fenced(room_numbers, lambda pipe, n: pipe.pexpire(self._key('owner', n), ttl))
+
+    def _release(self, room_numbers):
+        leased = [n for n in room_numbers if self.leases.pop(n, None) is not None]
+        if leased:
+            self._fenced(leased, lambda pipe, n: pipe.delete(self._key('owner', n)))
+
+    def get_room(self, room_number: str):
+        if self._is_owned(room_number):
+            return self.rooms[room_number]
+
+        # 本进程负责但尚未持有租约时先取得租约再加载，保证读到旧owner最后写回的状态
+        if self.owner_check is not None and room_number not in self.leases and self.owner_check(room_number):
+            self._acquire(room_number)
+        raw = self.client.get(self._key('room', room_number))
+        if raw is None:
+            self.rooms.pop(room_number, None)
+            self._release([room_number])
+            return None
+
+        room = self.rooms.get(room_number)
+        if room is None:
+            room = self.room_cls.from_state(json.loads(raw))
+            self.rooms[room_number] = room
+        else:
+            room.load_state(json.loads(raw))
+        return room
+
+    def add_room(self, room) -> bool:
+        key = self._key('room', room.room_number)
+        if self.client.set(key, json.dumps(room.to_state()), nx=True):
+            self.client.sadd(self._key('rooms'), room.room_number)
+            self.rooms[room.room_number] = room
+            if self.owner_check is not None and self.owner_check(room.room_number):
+                self._acquire(room.room_number)
+            return True
+        return False
+
+    def delete_room(self, room_number: str) -> bool:
+        self.rooms.pop(room_number, None)
+        self.dirty.discard(room_number)
+        self._release([room_number])
+        self.client.srem(self._key('rooms'), room_number)
+        return self.client.delete(self._key('room', room_number)) > 0
+
+    def get_user_room(self, email: str):
+        room_number = self.client.hget(self._key('user-to-room'), email)
+        if isinstance(room_number, bytes):
+            room_number = room_number.decode()
+        return room_number
+
+    def set_user_room(self, email: str, room_number: str) -> bool:
+        return bool(self.client.hsetnx(self._key('user-to-room'), email, room_number))
+
+    def delete_user_room(self, email: str) -> bool:
+        return self.client.hdel(self._key('user-to-room'), email) > 0
+
+    @contextlib.contextmanager
+    def transaction(self, room):
+        # 加锁后从Redis加载最新状态，修改完成后写回；房间已被删除时不再写回
+        with room.lock:
+            with self._transaction(room):
+                yield room
+
+    @contextlib.contextmanager
+    def _transaction(self, room):
+        room_number = room.room_number
+        if self._is_owned(room_number):
+            yield room
+            self.dirty.add(room_number)
+            return
+
+        held = self._local.__dict__.setdefault('held', {})
+        if held.get(room_number):
+            held[room_number] += 1
+            try:
+                yield room
+            finally:
+                held[room_number] -= 1
+            return
+
+        # 其他worker持有租约时房间在其内存中修改并由其写回，本进程的写入会与之互相覆盖，直接拒绝；
+        # 检查到写回期间WATCH租约，事务执行中租约被取得时同样放弃写回
+        from redis.exceptions import WatchError
+
+        key = self._key('room', room_number)
+        owner_key = self._key('owner', room_number)
+        with self.client.lock(self._key('lock', room_number), timeout=self.lock_timeout,
+                              blocking_timeout=self.lock_timeout), self.client.pipeline() as pipe:
+            held[room_number] = 1
+            try:
+                pipe.watch(owner_key)
+                owner = pipe.get(owner_key)
+                owner = owner.decode() if isinstance(owner, bytes) else owner
+                if owner is not None and owner != self.worker_id:
+                    raise RoomOwnedElsewhere('room(%s) is owned by worker(%s)' % (room_number, owner))
+                raw = pipe.get(key)
+                if raw is not None:
+                    room.load_state(json.loads(raw))
+                yield room
+                pipe.multi()
+                pipe.set(key, json.dumps(room.to_state()), xx=True)
+                try:
+                    pipe.execute()
+                except WatchError:
+                    raise RoomOwnedElsewhere('room(%s) was claimed during the transaction' % room_number)
+            finally:
+                del held[room_number]
+
+    def stats(self) -> dict:
+        return {'rooms': self.client.scard(self._key('rooms')), 'users': self.client.hlen(self._key('user-to-room'))}
+
+    def register_worker(self, worker_id: str, url: str, ttl: float):
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.zadd(self._key('workers'), {worker_id: now + ttl})
+        pipe.hset(self._key('worker-urls'), worker_id, url)
+        pipe.execute()
+
+    def unregister_worker(self, worker_id: str):
+        pipe = self.client.pipeline()
+        pipe.zrem(self._key('workers'), worker_id)
+        pipe.hdel(self._key('worker-urls'), worker_id)
+        pipe.execute()
+
+    def get_workers(self) -> dict:
+        # 心跳过期的worker视为已退出
+        self.client.zremrangebyscore(self._key('workers'), '-inf', time.time())
+        worker_ids = [w.decode() if isinstance(w, bytes) else w for w in self.client.zrange(self._key('workers'), 0, -1)]
+        if not worker_ids:
+            return {}
+        urls = self.client.hmget(self._key('worker-urls'), worker_ids)
+        return {w: u.decode() if isinstance(u, bytes) else u for w, u in zip(worker_ids, urls) if u is not None}
+
+    def cached_room_numbers(self) -> list:
+        return list(self.rooms.keys())
+
+    def release_rooms(self, room_numbers):
+        # 房间迁移给其他worker前写回Redis并释放租约，再从本进程内存中移除
+        room_numbers = list(room_numbers)
+        self.flush_rooms(room_numbers)
+        self._release(room_numbers)
+        for room_number in room_numbers:
+            self.rooms.pop(room_number, None)
+
+    def flush_rooms(self, room_numbers=None):
+        # 只写回租约仍属于本进程的房间，同时续约
+        room_numbers = set(self.dirty) if room_numbers is None else self.dirty.intersection(room_numbers)
+        if not room_numbers:
+            return
+        ttl = int(self.lease_ttl * 1000)
+
+        def write(pipe, room_number):
+            room = self.rooms.get(room_number)
+            if room is not None:
+                pipe.set(self._key('room', room_number), json.dumps(room.to_state()), xx=True)
+            pipe.pexpire(self._key('owner', room_number), ttl)
+
+        self._fenced(room_numbers, write)
+        self.dirty.difference_update(room_numbers)
+
+    def renew_leases(self):
+        # 由ShardRouter每次心跳调用，租约有效期应大于心跳间隔
+        if self.leases:
+            self._renew(*list(self.leases))
+
+
+def create_store(room_cls, url: str = None):
+    # 未配置url时使用进程内存储
+    if not url:
+        return MemoryStore(room_cls)
+
+    import redis
+    return RedisStore(room_cls, redis.Redis.from_url(url))
@@ -1,6 +1,30 @@
+import contextlib
 import functools
+import hashlib
+import json
+import secrets
+import threading
+import time
+from flask import current_app, request
 from flask_socketio import emit
-from app import socketio_namespace, app
+from extensions import socketio_namespace, socketio, start_background_task
+import wire
+import metrics
+from store import create_store
+from utils import now_ms, TimerWheel
+from shard import ShardRouter
+from journal import RoomJournal
+import drift
+
+
+def record_emit(event: str, payload, recipients: int, size: int = None):
+    # 统计发送次数、送达成员数和编码后字节数，JSON按socket.io的紧凑格式计算；
+    # 完整快照由调用方传入缓存的编码长度，其余JSON消息（增量、指令）很小，每次发送只序列化一次，与送达人数无关
+    if size is None:
+        size = len(payload) if isinstance(payload, bytes) else len(json.dumps(payload, separators=(',', ':')))
+    metrics.emitted_messages.inc(event)
+    metrics.emitted_recipients.inc(event, amount=recipients)
+    metrics.emitted_bytes.inc(event, amount=size * recipients)
 
 
 class Singleton(object):
@@ -23,14 +47,26 @@ class User:
         self._tab_id = tab_id
         self._video_state = 'init'  # onload oncanplay onplaying onpause
         self._video_progress = 0
+        self._rtt = None  # 网络往返时延（毫秒）
+        self._clock_offset = None  # 客户端时钟减服务端时钟（毫秒）
+        self._codec = wire.JSON  # socket消息编码 json / msgpack
+        self.progress_at = None  # 最近一次上报video_progress的服务端时间（毫秒），用于推算当前进度
 
     @staticmethod
     def keys():
-        return 'email', 'nickname', 'url', 'tab_id', 'socketio', 'video_state', 'video_progress'
+        return 'email', 'nickname', 'url', 'tab_id', 'socketio', 'video_state', 'video_progress', 'rtt', 'clock_offset', 'codec'
 
     def __getitem__(self, item):
         return getattr(self, item)
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        user = cls(data['email'], data['nickname'], data['tab_id'])
+        for key in Room.user_fields:
+            if key in data:
+                setattr(user, key, data[key])
+        return user
+
     @property
     def url(self):
         return self._url
@@ -71,73 +107,416 @@ class User:
     def video_progress(self, progress: int):
         self._video_progress = progress
 
+    @property
+    def rtt(self):
+        return self._rtt
+
+    @rtt.setter
+    def rtt(self, rtt: int):
+        self._rtt = rtt
+
+    @property
+    def clock_offset(self):
+        return self._clock_offset
+
+    @clock_offset.setter
+    def clock_offset(self, offset: int):
+        self._clock_offset = offset
+
+    @property
+    def codec(self):
+        return self._codec
+
+    @codec.setter
+    def codec(self, codec: str):
+        self._codec = codec
+
+    def measure_clock(self, sent_at: int, received_at: int, client_time: int, alpha: float = 0.25):
+        # 根据一次clockPing/clockPong计算RTT和时钟偏移，并做指数平滑，返回平滑后的(rtt, clock_offset)
+        rtt = max(received_at - sent_at, 0)
+        offset = client_time - (sent_at + rtt / 2)
+        if self.rtt is not None:
+            rtt = self.rtt + alpha * (rtt - self.rtt)
+            offset = self.clock_offset + alpha * (offset - self.clock_offset)
+        return int(round(rtt)), int(round(offset))
+
+
+class SyncBarrier:
+    def __init__(self, generation: int, emails, timeout: float):
+        self.generation: int = generation  # 屏障代数，客户端updateState需携带，过期代数的消息被拒绝
+        self.pending: set[str] = set(emails)  # 尚未就绪的成员，len即待就绪计数
+        self.stragglers: set[str] = set()  # 超时仍未就绪而被放弃等待的成员
+        self.created_at: float = time.time()
+        self.deadline: float = self.created_at + timeout
+        self.released: bool = False  # 已发送播放指令
+
+    def update(self, email: str, state: int) -> bool:
+        # 更新成员就绪状态，返回是否应当释放屏障
+        if self.released:
+            return False
+        if state == 0:
+            self.pending.add(email)
+        else:
+            self.pending.discard(email)
+        return self.is_all_ready()
+
+    def discard(self, email: str) -> bool:
+        # 成员离开房间时不再等待它
+        self.pending.discard(email)
+        return not self.released and self.is_all_ready()
+
+    def expire(self) -> bool:
+        # 超时后放弃等待剩余成员，返回是否应当释放屏障
+        if self.released:
+            return False
+        self.stragglers = self.pending
+        self.pending = set()
+        return True
+
+    def is_all_ready(self) -> bool:
+        return len(self.pending) == 0
+
+    def to_state(self) -> dict:
+        return {
+            'generation': self.generation,
+            'pending': list(self.pending),
+            'stragglers': list(self.stragglers),
+            'created_at': self.created_at,
+            'deadline': self.deadline,
+            'released': self.released,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict):
+        barrier = cls(state['generation'], state['pending'], 0)
+        barrier.stragglers = set(state['stragglers'])
+        barrier.created_at = state['created_at']
+        barrier.deadline = state['deadline']
+        barrier.released = state['released']
+        return barrier
+
 
 class Room:
+    user_fields = ('url', 'tab_id', 'socketio', 'video_state', 'video_progress', 'rtt', 'clock_offset',
+                   'codec')  # 可通过update_user修改的字段
+    observer = None  # 播放状态或成员状态变化时通知的DriftMonitor，由DriftMonitor.start设置
+
     def __init__(self, room_number: str, room_url: str):
         self.room_number: str = room_number
         self.room_url: str = room_url
         self.video_identify: str = ''
+        # 权威播放记录：播放状态、视频位置（秒）和设置该位置的服务端时间（毫秒），由videoAction指令更新
+        self.playback: dict = {'state': 'paused', 'position': 0, 'at': 0}
         self.users: dict[str, User] = {}  # email -> user
-        self.sync_state: [{str, int}] = []  # email -> [0, 1]
+        self.sync_barrier: SyncBarrier | None = None  # 只保留当前一次同步的屏障
+        self.sync_generation: int = 0
+        self.version: int = 0  # 房间状态版本号，每次广播变更后递增
+        self._patch: dict = {}  # 尚未广播的变更 {'room': {field: value}, 'users': {email: {field: value} | None}}
+        self._batch_depth: int = 0  # batch()嵌套层数，大于0时变更只累积不广播
+        self._info_cache: dict = {}  # get_room_info的序列化缓存，房间或成员字段变化时清空
+        # 房间锁，同一房间的修改串行执行，不同房间互不阻塞；由store.transaction获取，可重入
+        # 锁顺序：房间锁在最外层，持有时可以再取日志锁、存储索引锁、Redis房间锁和各单例内部的锁；
+        # 持有这些锁时不能再取任何房间锁（包括to_state和序列化缓存），需要遍历多个房间时先释放自己的锁，
+        # 同一线程也不能同时持有两个房间的锁
+        self.lock = threading.RLock()
+
+    def to_state(self) -> dict:
+        # 存入共享存储的房间状态
+        with self.lock:
+            return {
+                'version': self.version,
+                'room_number': self.room_number,
+                'room_url': self.room_url,
+                'video_identify': self.video_identify,
+                'playback': self.playback,
+                'users': {k: dict(v) for k, v in self.users.items()},
+                'sync_generation': self.sync_generation,
+                'sync_barrier': self.sync_barrier.to_state() if self.sync_barrier else None,
+            }
 
-    def init_new_sync_state(self):
-        app.logger.info('init_new_sync_state')
-        new_state = {email: 0 for email in self.users.keys()}
-        self.sync_state.append(new_state)
+    @classmethod
+    def from_state(cls, state: dict):
+        room = cls(state['room_number'], state['room_url'])
+        room.load_state(state)
+        return room
 
-    def update_sync_state(self, email: str, state: int):
-        app.logger.info('%s update_sync_state' % email)
-        self.sync_state[-1][email] = state
-        if self.is_sync_state_all_ready():
-            self.emit_play_order()
+    def load_state(self, state: dict):
+        # 用共享存储中的最新状态覆盖本地状态，本地尚未广播的变更重新应用在其上
+        self.version = state['version']
+        self.room_url = state['room_url']
+        self.video_identify = state['video_identify']
+        self.playback = state.get('playback', self.playback)
+        self.users = {k: User.from_dict(v) for k, v in state['users'].items()}
+        self.sync_generation = state['sync_generation']
+        barrier = state['sync_barrier']
+        self.sync_barrier = SyncBarrier.from_state(barrier) if barrier else None
+        self._info_cache.clear()
+        self.apply_patch(self._patch)
+        self._notify()
+
+    def apply_patch(self, patch: dict):
+        self._info_cache.clear()
+        for field, value in patch.get('room', {}).items():
+            setattr(self, field, value)
+        for email, fields in patch.get('users', {}).items():
+            if fields is None:
+                self.users.pop(email, None)
+            elif 'email' in fields:
+                self.users[email] = User.from_dict(fields)
+            elif email in self.users:
+                for field, value in fields.items():
+                    setattr(self.users[email], field, value)
+
+    @staticmethod
+    def transactional(func):
+        # 在存储事务中执行：多进程共享存储时先加载最新状态，执行后写回
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with Manage().store.transaction(self):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    @transactional
+    def init_new_sync_state(self) -> SyncBarrier:
+        current_app.logger.info('room(%s) init_new_sync_state', self.room_number, extra={'event': 'init'})
+        self.sync_generation += 1
+        timeout = current_app.config['SYNC_BARRIER_TIMEOUT']
+        self.sync_barrier = SyncBarrier(self.sync_generation, self.users.keys(), timeout)
+        if timeout > 0:
+            start_background_task(self._expire_sync_barrier, self.sync_generation, timeout)
+        return self.sync_barrier
+
+    @transactional
+    def update_sync_state(self, email: str, state: int, generation: int = None) -> bool:
+        current_app.logger.info('%s update_sync_state', email, extra={'event': 'updateState'})
+        barrier = self.sync_barrier
+        if barrier is None or (generation is not None and generation != barrier.generation):
+            current_app.logger.info('%s stale sync state generation(%s) rejected', email, generation)
+            return False
+        # 已离开房间的成员不再参与屏障，否则state=0会把它重新加入pending，屏障只能等到超时
+        if email not in self.users:
+            current_app.logger.info('%s not in room(%s), sync state ignored', email, self.room_number)
+            return False
+
+        if barrier.update(email, state):
+            self.release_sync_barrier()
+        return True
 
     def is_sync_state_all_ready(self) -> bool:
-        res = True
-        for email, state in self.sync_state[-1].items():
-            if state == 0:
-                res = False
-                break
-        return res
+        return self.sync_barrier is None or self.sync_barrier.is_all_ready()
+
+    def release_sync_barrier(self):
+        barrier = self.sync_barrier
+        barrier.released = True
+        metrics.sync_barrier_wait_seconds.observe(time.time() - barrier.created_at,
+                                                  'timeout' if barrier.stragglers else 'ready')
+        self.emit_play_order()
+
+    def _expire_sync_barrier(self, generation: int, timeout: float):
+        socketio.sleep(timeout)
+        self._release_expired_sync_barrier(generation)
+
+    @transactional
+    def _release_expired_sync_barrier(self, generation: int):
+        barrier = self.sync_barrier
+        if barrier is not None and barrier.generation == generation and barrier.expire():
+            current_app.logger.info('room(%s) sync generation(%s) timeout, stragglers: %s',
+                            self.room_number, generation, ', '.join(barrier.stragglers))
+            self.release_sync_barrier()
+
+    def execute_at(self) -> int:
+        # 指令的服务端执行时间（毫秒）：留出房间内最慢连接单程时延的余量，客户端按 at + clock_offset 换算为本地时间执行
+        rtts = [user.rtt for user in self.users.values() if user.socketio and user.rtt is not None]
+        config = current_app.config
+        lead = min(max(rtts, default=0) / 2 + config['CLOCK_LEAD_MARGIN'], config['CLOCK_LEAD_MAX'])
+        return now_ms() + int(lead)
 
     def emit_pause_and_jump_order(self, time: int, sync_type: str):
-        emit('videoAction', {'action': 'pause', 'time': time, 'type': sync_type}, to=self.room_number,
-             namespace=socketio_namespace)
+        data = {'action': 'pause', 'time': time, 'type': sync_type, 'generation': self.sync_generation,
+                'at': self.execute_at()}
+        self.broadcast('videoAction', data)
+        self.set_playback('paused', time, data['at'])
 
     def emit_play_order(self):
-        emit('videoAction', {'action': 'play'}, to=self.room_number, namespace=socketio_namespace)
+        data = {'action': 'play', 'generation': self.sync_generation, 'at': self.execute_at()}
+        self.broadcast('videoAction', data)
+        self.set_playback('playing', self.current_playback(data['at'])['position'], data['at'])
 
     def emit_update_url_order(self, url: str):
-        emit('videoAction', {'action': 'updateUrl', 'url': url}, include_self=False, to=self.room_number,
-             namespace=socketio_namespace)
+        self.broadcast('videoAction', {'action': 'updateUrl', 'url': url}, skip_sid=request.sid)
+        self.set_playback('paused', 0, now_ms())
+
+    def current_playback(self, now: int = None) -> dict:
+        # 由权威播放记录推算now（服务端毫秒）时的播放位置，O(1)；新加入的成员直接跳转到该位置，无需整个房间重新同步
+        playback = self.playback
+        now = now_ms() if now is None else now
+        position = playback['position'] or 0
+        if playback['state'] == 'playing' and now > playback['at']:
+            position += (now - playback['at']) / 1000
+        return {'state': playback['state'], 'position': position, 'at': now}
+
+    def emit_playback(self, codec: str = wire.JSON):
+        # 发给当前连接，客户端按 at + clock_offset 换算为本地时间后跳转
+        payload = wire.encode(self.current_playback(), codec)
+        emit('playback', payload, namespace=socketio_namespace)
+        record_emit('playback', payload, 1)
+
+    def emit_resume_token(self, token: str | None, ttl: float, codec: str = wire.JSON):
+        # 发给当前连接，断线后在ttl秒内携带令牌重连可静默恢复
+        if token is None:
+            return
+        payload = wire.encode({'token': token, 'ttl': ttl}, codec)
+        emit('resume', payload, namespace=socketio_namespace)
+        record_emit('resume', payload, 1)
+
+    def channel(self, codec: str) -> str:
+        # 每种编码的连接加入各自的socket.io房间，JSON连接沿用房间号
+        return self.room_number if codec == wire.JSON else '%s#%s' % (self.room_number, codec)
+
+    def codecs(self) -> dict:
+        # 已连接成员使用的编码 -> 成员数
+        codecs = {}
+        for user in self.users.values():
+            if user.socketio:
+                codecs[user.codec] = codecs.get(user.codec, 0) + 1
+        return codecs
+
+    def broadcast(self, event: str, data: dict, skip_sid: str = None):
+        # 按成员协商的编码分别编码一次后广播；发送积压的连接由Outbox暂存或合并，不在本次广播中发送
+        outbox = Outbox()
+        for codec, count in self.codecs().items():
+            payload = wire.encode(data, codec)
+            held = outbox.hold(self.room_number, codec, event, payload, skip_sid)
+            skip = held + [skip_sid] if skip_sid else held
+            socketio.emit(event, payload, to=self.channel(codec), skip_sid=skip or None, namespace=socketio_namespace)
+            record_emit(event, payload, count - len(held))
 
     def get_room_info(self):
-        # 获取对象的字典表示形式
-        users_data = {k: dict(v) for k, v in self.users.items()}
-        room_data = {
-            'room_number': self.room_number,
-            'room_url': self.room_url,
-            'video_identify': self.video_identify,
-            'users': users_data
-        }
+        # 获取对象的字典表示形式，结果缓存到下一次修改，调用方不能修改返回值
+        room_data = self._info_cache.get('info')
+        if room_data is None:
+            with self.lock:  # 修改都持有房间锁，缓存不会写入修改到一半的状态
+                users_data = {k: dict(v) for k, v in self.users.items()}
+                room_data = self._info_cache['info'] = {
+                    'version': self.version,
+                    'room_number': self.room_number,
+                    'room_url': self.room_url,
+                    'video_identify': self.video_identify,
+                    'playback': self.playback,
+                    'users': users_data
+                }
         return room_data
 
+    def get_room_json(self) -> tuple[str, str]:
+        # 缓存的房间JSON及其ETag（内容散列），用于/profile的条件请求
+        cached = self._info_cache.get('json')
+        if cached is None:
+            with self.lock:
+                body = json.dumps(self.get_room_info(), separators=(',', ':'))
+                cached = self._info_cache['json'] = (body, hashlib.sha1(body.encode()).hexdigest()[:20])
+        return cached
+
+    def encoded_room_info(self, codec: str):
+        # 按编码缓存的完整快照，JSON由socket.io序列化，直接复用缓存的字典
+        payload = self._info_cache.get(('panel', codec))
+        if payload is None:
+            with self.lock:
+                payload = self._info_cache[('panel', codec)] = wire.encode(self.get_room_info(), codec)
+        return payload
+
+    def encoded_room_size(self, codec: str) -> int:
+        # 完整快照编码后的字节数，JSON复用get_room_json缓存的字符串，不再序列化
+        payload = self.encoded_room_info(codec)
+        return len(payload) if isinstance(payload, bytes) else len(self.get_room_json()[0])
+
+    def emit_room_snapshot(self, codec: str = wire.JSON):
+        # 完整快照只发给当前连接，用于加入房间和客户端请求重新同步
+        payload = self.encoded_room_info(codec)
+        emit('room-panel', payload, namespace=socketio_namespace)
+        record_emit('room-panel', payload, 1, self.encoded_room_size(codec))
+
+    @transactional
+    def emit_room_patch(self):
+        # 将累积的变更作为增量广播，版本号单调递增；客户端发现版本不连续时应发送resync请求完整快照
+        if not self._patch:
+            return
+        self.version += 1
+        self._info_cache.clear()
+        data = {'version': self.version, **self._patch}
+        self._patch = {}
+        Manage().record_patch(self, data)
+        # 可能在后台定时任务中调用，没有请求上下文，broadcast使用socketio.emit
+        self.broadcast('room-patch', data)
+
+    def _notify(self, email: str = None):
+        # 通知DriftMonitor更新房间全部成员或指定成员的行
+        if Room.observer is not None:
+            Room.observer.room_changed(self, email)
+
+    def _set_room_field(self, field: str, value):
+        if getattr(self, field) != value:
+            setattr(self, field, value)
+            self._info_cache.clear()
+            self._patch.setdefault('room', {})[field] = value
+            if field == 'playback':
+                self._notify()
+
+    def _set_user_field(self, email: str, field: str, value):
+        user = self.users[email]
+        if user[field] != value:
+            setattr(user, field, value)
+            self._info_cache.clear()
+            users_patch = self._patch.setdefault('users', {})
+            users_patch.setdefault(email, {})[field] = value
+            if field in ('socketio', 'video_state'):
+                self._notify(email)
+
+    @contextlib.contextmanager
+    def batch(self):
+        # 合并多次修改，退出最外层时只广播一次
+        with Manage().store.transaction(self):
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.emit_room_patch()
+
     @staticmethod
     def user_info_change_notify(func):
         @functools.wraps(func)
         def wrapper(self, *args, **kwargs):
-            res = func(self, *args, **kwargs)
-            data = self.get_room_info()
-            emit('room-panel', data, namespace=socketio_namespace, to=self.room_number)
+            with Manage().store.transaction(self):
+                res = func(self, *args, **kwargs)
+                if self._batch_depth == 0:
+                    self.emit_room_patch()
             return res
 
         return wrapper
 
+    @user_info_change_notify
+    def set_room_url(self, room_url: str):
+        self._set_room_field('room_url', room_url)
+
+    @user_info_change_notify
+    def set_video_identify(self, video_identify: str):
+        self._set_room_field('video_identify', video_identify)
+
+    @user_info_change_notify
+    def set_playback(self, state: str, position, at: int):
+        self._set_room_field('playback', {'state': state, 'position': position, 'at': at})
+
     @user_info_change_notify
     def add_user(self, user: User) -> bool:
         email = user.email
 
         if email not in self.users:
             self.users[email] = user
+            self._info_cache.clear()
+            self._patch.setdefault('users', {})[email] = dict(user)
+            self._notify(email)
             return True
 
         return False
@@ -146,15 +525,55 @@ class Room:
     def delete_user(self, email: str) -> bool:
         if email in self.users:
             del self.users[email]
+            self._info_cache.clear()
+            self._patch.setdefault('users', {})[email] = None
+            self._notify(email)
+            if self.sync_barrier is not None and self.sync_barrier.discard(email):
+                self.release_sync_barrier()
             return True
 
         return False
 
+    @user_info_change_notify
+    def update_user(self, email: str, **fields) -> bool:
+        # 一次修改用户的多个字段，例如 update_user(email, socketio=True, video_state='init')
+        if email not in self.users:
+            return False
+
+        for field, value in fields.items():
+            if field not in self.user_fields:
+                raise KeyError('unknown user field: %s' % field)
+            self._set_user_field(email, field, value)
+        return True
+
+    def report_user(self, email: str, **fields) -> bool:
+        # 客户端高频上报的进度和状态只累积变更，由RoomFlusher按固定间隔合并广播
+        with self.lock:
+            if email not in self.users:
+                return False
+
+            for field, value in fields.items():
+                if field not in self.user_fields:
+                    raise KeyError('unknown user field: %s' % field)
+                self._set_user_field(email, field, value)
+            if 'video_progress' in fields:
+                self.users[email].progress_at = now_ms()
+                self._notify(email)
+
+            if self._patch:
+                RoomFlusher().mark(self)
+            return True
+
+    def report_clock(self, email: str, sent_at: int, client_time: int) -> bool:
+        if email not in self.users:
+            return False
+        rtt, offset = self.users[email].measure_clock(sent_at, now_ms(), client_time)
+        return self.report_user(email, rtt=rtt, clock_offset=offset)
+
     @user_info_change_notify
     def set_user_video_progress(self, email: str, video_progress: int) -> bool:
         if email in self.users:
-            user = self.users[email]
-            user.video_progress = video_progress
+            self._set_user_field(email, 'video_progress', video_progress)
             return True
 
         return False
@@ -162,8 +581,7 @@ class Room:
     @user_info_change_notify
     def set_user_socketio(self, email: str, socket: bool) -> bool:
         if email in self.users:
-            user = self.users[email]
-            user.socketio = socket
+            self._set_user_field(email, 'socketio', socket)
             return True
 
         return False
@@ -171,51 +589,558 @@ class Room:
     @user_info_change_notify
     def set_user_video_state(self, email: str, video_state: int) -> bool:
         if email in self.users:
-            user = self.users[email]
-            user.video_state = video_state
+            self._set_user_field(email, 'video_state', video_state)
             return True
 
         return False
 
 
+@Singleton
+class RoomFlusher:
+    def __init__(self):
+        self.interval: float = current_app.config['ROOM_FLUSH_INTERVAL']
+        self.dirty_rooms: dict[str, Room] = {}  # room number -> room，有未广播变更的房间
+        self._lock = threading.Lock()  # 保护dirty_rooms的登记和交换，持有时不取房间锁
+        self._started = False
+
+    def mark(self, room: Room):
+        if self.interval <= 0:
+            room.emit_room_patch()
+            return
+        with self._lock:
+            self.dirty_rooms[room.room_number] = room
+
+    def start(self):
+        if not self._started and self.interval > 0:
+            self._started = True
+            start_background_task(self._run)
+
+    def flush(self):
+        # 没有变更的房间不会出现在dirty_rooms中，也不会发送任何消息
+        with self._lock:
+            rooms, self.dirty_rooms = self.dirty_rooms, {}
+        for room in rooms.values():
+            room.emit_room_patch()
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                current_app.logger.exception('room flush failed: %s', e)
+
+
+class Connection:
+    def __init__(self, email: str, room_number: str, codec: str):
+        self.email = email
+        self.room_number = room_number
+        self.codec = codec
+        self.pending: tuple | None = None  # 暂存的最新状态消息 (event, payload)，payload为None时发送时再生成快照
+        self.behind_since: float | None = None  # 发送积压超过上限的起始时间
+        self.dropped: bool = False  # 积压超时，等待后台任务断开
+
+
+@Singleton
+class Outbox:
+    # 每个连接的发送积压（engine.io发送队列长度）超过上限时，房间状态消息（room-panel/room-patch）只在连接上保留最新一条，
+    # 积压下降后再发送；多条状态消息合并为一次完整快照。videoAction等控制消息不受影响，始终立即按顺序发送
+    # 积压持续超过slow_timeout的连接被断开
+    conflated_events = ('room-panel', 'room-patch')
+
+    def __init__(self):
+        self.max_backlog: int = current_app.config['OUTBOX_MAX_BACKLOG']
+        self.slow_timeout: float = current_app.config['OUTBOX_SLOW_TIMEOUT']
+        self.interval: float = current_app.config['OUTBOX_DRAIN_INTERVAL']
+        # 多进程共享消息队列但不分片时，同一房间的连接分布在多个进程，无法按连接控制发送
+        self.enabled = self.max_backlog > 0 and not (current_app.config['SOCKETIO_MESSAGE_QUEUE']
+                                                     and not current_app.config['WORKER_URL'])
+        self.connections: dict[str, Connection] = {}  # sid -> connection
+        self.rooms: dict[str, set[str]] = {}  # room number -> sids
+        self._lock = threading.Lock()
+        self._started = False
+
+    def register(self, sid: str, email: str, room_number: str, codec: str):
+        self.unregister(sid)
+        with self._lock:
+            self.connections[sid] = Connection(email, room_number, codec)
+            self.rooms.setdefault(room_number, set()).add(sid)
+
+    def unregister(self, sid: str):
+        with self._lock:
+            conn = self.connections.pop(sid, None)
+            if conn is not None:
+                sids = self.rooms.get(conn.room_number)
+                if sids is not None:
+                    sids.discard(sid)
+                    if not sids:
+                        del self.rooms[conn.room_number]
+
+    def backlog(self, sid: str) -> int:
+        # engine.io中尚未写出的数据包数量
+        server = socketio.server
+        socket = server.eio.sockets.get(server.manager.eio_sid_from_sid(sid, socketio_namespace))
+        return socket.queue.qsize() if socket is not None else 0
+
+    def slow_connections(self) -> int:
+        with self._lock:
+            connections = list(self.connections.values())
+        return sum(1 for conn in connections if conn.behind_since is not None)
+
+    def _check(self, sid: str, conn: Connection, now: float) -> int:
+        # 返回当前积压，长时间积压的连接被标记断开时返回-1
+        # hold在广播中途、持有房间锁时调用，disconnect事件会同步执行并修改房间，因此只做标记，由后台任务断开
+        if conn.dropped:
+            return -1
+        backlog = self.backlog(sid)
+        if backlog < self.max_backlog:
+            conn.behind_since = None
+        elif conn.behind_since is None:
+            conn.behind_since = now
+        elif self.slow_timeout > 0 and now - conn.behind_since >= self.slow_timeout:
+            current_app.logger.info('socket(%s) backlog %d for %.1fs, disconnect', sid, backlog,
+                                    now - conn.behind_since)
+            metrics.slow_disconnects.inc()
+            conn.dropped = True
+            start_background_task(self._disconnect, sid)
+            return -1
+        return backlog
+
+    def _disconnect(self, sid: str):
+        self.unregister(sid)
+        socketio.server.disconnect(sid, namespace=socketio_namespace)
+
+    def hold(self, room_number: str, codec: str, event: str, payload, skip_sid: str = None) -> list:
+        # 返回本次广播需要跳过的连接：发送积压的连接暂存状态消息，已断开的慢连接直接跳过
+        if not self.enabled or event not in self.conflated_events:
+            return []
+        held = []
+        now = time.monotonic()
+        with self._lock:
+            sids = list(self.rooms.get(room_number, ()))
+        for sid in sids:
+            conn = self.connections.get(sid)
+            if conn is None or conn.codec != codec or sid == skip_sid:
+                continue
+            backlog = self._check(sid, conn, now)
+            if backlog < 0:
+                held.append(sid)
+            elif conn.pending is not None or backlog >= self.max_backlog:
+                if conn.pending is not None:
+                    # 新的完整快照直接覆盖；增量叠加在未发送的消息上时改为发送时生成完整快照
+                    metrics.conflated_messages.inc(conn.pending[0])
+                    conn.pending = (event, payload) if event == 'room-panel' else ('room-panel', None)
+                else:
+                    conn.pending = (event, payload)
+                held.append(sid)
+        if held:
+            self.start()
+        return held
+
+    def drain(self):
+        now = time.monotonic()
+        with self._lock:
+            connections = list(self.connections.items())
+        for sid, conn in connections:
+            if conn.pending is None or not 0 <= self._check(sid, conn, now) < self.max_backlog:
+                continue
+            event, payload = conn.pending
+            conn.pending = None
+            size = None
+            if payload is None:
+                room = Manage().get_room(conn.room_number)
+                if room is None:
+                    continue
+                payload = room.encoded_room_info(conn.codec)
+                size = room.encoded_room_size(conn.codec)
+            socketio.emit(event, payload, to=sid, namespace=socketio_namespace)
+            record_emit(event, payload, 1, size)
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.drain()
+            except Exception as e:
+                current_app.logger.exception('outbox drain failed: %s', e)
+
+
+@Singleton
+class ClockSync:
+    # 定时向/room命名空间所有连接发送clockPing，客户端回复clockPong后更新RTT和时钟偏移
+    def __init__(self):
+        self.interval: float = current_app.config['CLOCK_PING_INTERVAL']
+        self._started = False
+
+    def ping(self, to: str = None):
+        data = {'t': now_ms()}
+        socketio.emit('clockPing', data, to=to, namespace=socketio_namespace)
+        record_emit('clockPing', data, 1 if to else int(metrics.connected_sockets.value()))
+
+    def start(self):
+        if not self._started and self.interval > 0:
+            self._started = True
+            start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.ping()
+            except Exception as e:
+                current_app.logger.exception('clock ping failed: %s', e)
+
+
+@Singleton
+class DriftMonitor:
+    # 定时一次性计算所有房间播放中成员相对房间权威播放位置的偏差，只向超出容差的成员单独发送videoAction：
+    # 偏差较小时调整播放速率（rate）逐渐追上，偏差过大时跳转（seek），回到容差内后恢复正常速率
+    def __init__(self):
+        self.interval: float = current_app.config['DRIFT_CHECK_INTERVAL']
+        self.tolerance: float = current_app.config['DRIFT_TOLERANCE']
+        self.seek_threshold: float = current_app.config['DRIFT_SEEK_THRESHOLD']
+        self.window: float = current_app.config['DRIFT_CORRECTION_WINDOW']
+        self.max_rate_adjust: float = current_app.config['DRIFT_MAX_RATE_ADJUST']
+        self.max_report_age: int = int(current_app.config['DRIFT_MAX_REPORT_AGE'] * 1000)
+        # 每个已加入房间的连接一行，列中还保存本模块设置的播放速率(rate)和最近一次纠正的时间(corrected_at)，
+        # 之前的进度上报不再参与计算；持有_lock时不取房间锁
+        self.table = drift.MemberTable()
+        self.members: dict[str, tuple[str, str]] = {}  # sid -> (room number, email)
+        self.sids: dict[str, dict[str, set[str]]] = {}  # room number -> email -> sids
+        self._lock = threading.Lock()
+        self._started = False
+
+    def track(self, sid: str, room: Room, email: str):
+        # 连接加入房间时登记，之后由房间的状态变化通知更新
+        if self.interval <= 0:
+            return
+        self.untrack(sid)
+        with self._lock:
+            self.members[sid] = (room.room_number, email)
+            self.sids.setdefault(room.room_number, {}).setdefault(email, set()).add(sid)
+            self.table.add(sid)
+            self._refresh(room, email)
+
+    def untrack(self, sid: str):
+        with self._lock:
+            member = self.members.pop(sid, None)
+            if member is None:
+                return
+            self.table.remove(sid)
+            room_number, email = member
+            emails = self.sids[room_number]
+            emails[email].discard(sid)
+            if not emails[email]:
+                del emails[email]
+                if not emails:
+                    del self.sids[room_number]
+
+    def room_changed(self, room: Room, email: str = None):
+        # 由Room在持有房间锁时调用
+        with self._lock:
+            if room.room_number in self.sids:
+                self._refresh(room, email)
+
+    def _refresh(self, room: Room, email: str = None):
+        emails = self.sids.get(room.room_number, {})
+        playback = room.playback
+        values = {'reference': playback['position'] or 0, 'reference_at': playback['at']}
+        for email in (email,) if email is not None else list(emails):
+            user = room.users.get(email)
+            playing = (playback['state'] == 'playing' and user is not None and user.socketio
+                       and user.video_state == 'onplaying' and user.progress_at is not None)
+            if user is not None:
+                values.update(progress=user.video_progress or 0, progress_at=user.progress_at or 0)
+            for sid in emails.get(email, ()):
+                self.table.update(sid, playing=playing, **values)
+
+    @metrics.drift_check_seconds.time()
+    def check(self, now: int = None):
+        now = now_ms() if now is None else now
+        with self._lock:
+            sids, columns = self.table.select(now, self.max_report_age)
+        if not len(sids):
+            return
+        reference, _, action, target = drift.detect(*columns, now, self.tolerance, self.seek_threshold, self.window,
+                                                    self.max_rate_adjust)
+        at = now + current_app.config['CLOCK_LEAD_MARGIN']
+        connections = Outbox().connections
+        for i in drift.corrections(action):
+            sid = sids[i]
+            conn = connections.get(sid)
+            if conn is None:
+                continue
+            kind = int(action[i])
+            if kind == drift.SEEK:
+                data = {'action': 'seek', 'time': round(float(reference[i]) + (at - now) / 1000, 3), 'at': at}
+                rate = 1
+            else:
+                rate = 1 if kind == drift.RESET else round(float(target[i]), 3)
+                data = {'action': 'rate', 'rate': rate, 'at': at}
+            with self._lock:
+                self.table.update(sid, rate=rate, corrected_at=now)
+            payload = wire.encode(data, conn.codec)
+            socketio.emit('videoAction', payload, to=sid, namespace=socketio_namespace)
+            record_emit('videoAction', payload, 1)
+            metrics.drift_corrections.inc(data['action'] if kind != drift.RESET else 'reset')
+
+    def start(self):
+        if not self._started and self.interval > 0:
+            self._started = True
+            Room.observer = self
+            start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                current_app.logger.exception('drift check failed: %s', e)
+
+
+@Singleton
+class Reaper:
+    # 成员socket断开超过宽限期仍未重连时移出房间，房间没有成员后删除
+    # 定时器按email登记在时间轮中，连接时取消，断开时重新登记
+    def __init__(self):
+        self.grace: float = current_app.config['MEMBER_GRACE_PERIOD']
+        self.wheel = TimerWheel(current_app.config['REAPER_TICK'], current_app.config['REAPER_SLOTS'])
+        self._started = False
+
+    def schedule(self, email: str):
+        if self.grace > 0:
+            self.wheel.schedule(email, self.grace)
+            self.start()
+
+    def cancel(self, email: str):
+        self.wheel.cancel(email)
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            start_background_task(self._run)
+
+    def reap(self, now: float = None):
+        # 同一房间本次到期的成员合并为一次广播
+        manage = Manage()
+        rooms = {}
+        for email in self.wheel.advance(now):
+            room = manage.get_room_by_email(email)
+            if room is None:
+                continue
+            user = room.users.get(email)
+            if user is not None and user.socketio:
+                continue  # 已在其他worker上重连
+            rooms.setdefault(room.room_number, (room, []))[1].append(email)
+
+        for room, emails in rooms.values():
+            deleted = manage.leave(room, emails)
+            metrics.reaped.inc('member', amount=len(emails))
+            current_app.logger.info('room(%s) evicted disconnected members: %s', room.room_number, emails)
+            if deleted:
+                metrics.reaped.inc('room')
+                current_app.logger.info('room(%s) had been delete', room.room_number)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.wheel.tick)
+            try:
+                self.reap()
+            except Exception as e:
+                current_app.logger.exception('reaper failed: %s', e)
+
+
+class ResumeSession:
+    def __init__(self, token: str, email: str, room_number: str, codec: str, sid: str):
+        self.token = token
+        self.email = email
+        self.room_number = room_number
+        self.codec = codec
+        self.sid = sid
+        self.suspended = False  # socket已断开，等待在恢复窗口内重连
+
+
+@Singleton
+class Resumer:
+    # 连接时签发短期恢复令牌，socket断开后成员状态在恢复窗口内保持不变（不广播、不清零进度），
+    # 窗口内携带令牌重连时静默恢复；令牌过期后才执行原来的断开流程（广播离线并登记清理定时器）
+    def __init__(self):
+        self.window: float = current_app.config['RESUME_WINDOW']
+        self.wheel = TimerWheel(current_app.config['REAPER_TICK'], current_app.config['REAPER_SLOTS'])
+        self.sessions: dict[str, ResumeSession] = {}  # token -> session
+        self.by_email: dict[str, ResumeSession] = {}  # 每个成员只保留最新一次连接的令牌
+        self._lock = threading.Lock()
+        self._started = False
+
+    def issue(self, sid: str, email: str, room_number: str, codec: str) -> str | None:
+        if self.window <= 0:
+            return None
+        session = ResumeSession(secrets.token_urlsafe(16), email, room_number, codec, sid)
+        with self._lock:
+            old = self.by_email.get(email)
+            if old is not None:
+                self.sessions.pop(old.token, None)
+                self.wheel.cancel(old.token)
+            self.sessions[session.token] = session
+            self.by_email[email] = session
+        return session.token
+
+    def resume(self, token: str, sid: str, email: str, room_number: str, codec: str) -> bool:
+        # 令牌有效且属于同一成员、同一房间和编码时返回True，调用方跳过完整的连接流程
+        with self._lock:
+            session = self.sessions.get(token)
+            if session is None or (session.email, session.room_number, session.codec) != (email, room_number, codec):
+                return False
+            self.wheel.cancel(token)
+            session.sid = sid
+            session.suspended = False
+        return True
+
+    def is_current(self, sid: str, email: str) -> bool:
+        # 成员已在新连接上恢复时，旧连接迟到的断开事件不应修改成员状态
+        with self._lock:
+            session = self.by_email.get(email)
+            return session is None or session.sid == sid
+
+    def suspend(self, sid: str, email: str) -> bool:
+        # 断开时登记令牌过期定时器，返回False表示没有可恢复的令牌，调用方立即执行断开流程
+        with self._lock:
+            session = self.by_email.get(email)
+            if session is None or session.sid != sid:
+                return False
+            session.suspended = True
+            self.wheel.schedule(session.token, self.window)
+        self.start()
+        return True
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            start_background_task(self._run)
+
+    def expire(self, now: float = None):
+        expired = []
+        with self._lock:
+            for token in self.wheel.advance(now):
+                session = self.sessions.pop(token, None)
+                if session is None or not session.suspended:
+                    continue
+                if self.by_email.get(session.email) is session:
+                    del self.by_email[session.email]
+                expired.append(session)
+
+        manage = Manage()
+        for session in expired:
+            room = manage.get_room(session.room_number)
+            if room is None or session.email not in room.users:
+                continue
+            room.update_user(session.email, socketio=False, video_state='close', video_progress=0)
+            Reaper().schedule(session.email)
+            current_app.logger.info('%s resume token expired', session.email)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.wheel.tick)
+            try:
+                self.expire()
+            except Exception as e:
+                current_app.logger.exception('resumer failed: %s', e)
+
+
 @Singleton
 class Manage:
     def __init__(self):
-        self.rooms: dict[str, Room] = {}  # room number -> room
-        self.user_to_room: dict[str, Room] = {}  # email -> room
+        config = current_app.config
+        self.store = create_store(Room, config['ROOM_STORE_URL'])
+        self.router = ShardRouter(self.store, config['WORKER_ID'], config['WORKER_URL'],
+                                  config['SHARD_REPLICAS'], config['SHARD_HEARTBEAT'])
+        self.journal = None
+        # 共享存储本身已持久化，只有进程内存储需要日志
+        if config['ROOM_JOURNAL_DIR'] and not config['ROOM_STORE_URL']:
+            self.restore(RoomJournal(config['ROOM_JOURNAL_DIR'], config['ROOM_JOURNAL_COMPACT_EVERY'],
+                                     config['ROOM_JOURNAL_COMPACT_INTERVAL']))
+
+    def restore(self, journal: RoomJournal):
+        # 从快照和日志恢复房间与成员关系；原有socket连接已断开，成员重连时由connect事件重新加入
+        start = time.perf_counter()
+        states = journal.load()
+        for state in states.values():
+            room = Room.from_state(state)
+            room.sync_barrier = None
+            for user in room.users.values():
+                user.socketio = False
+            self.store.add_room(room)
+            for email in room.users:
+                self.store.set_user_room(email, room.room_number)
+                Reaper().schedule(email)
+        self.journal = journal
+        journal.compact(self.store.rooms.values())
+        current_app.logger.info('restored %d rooms from %s in %.3fs', len(states), journal.directory,
+                        time.perf_counter() - start)
+
+    def record_patch(self, room: Room, patch: dict):
+        if self.journal is not None:
+            self.journal.record_patch(room.room_number, patch)
+            if self.journal.compact_due():
+                # 调用方持有当前房间的锁，压缩需要读取所有房间的状态，放到后台任务中执行
+                start_background_task(self.journal.compact, self.store.rooms.values())
 
     def get_room(self, room_number: str):
-        if room_number in self.rooms:
-            room = self.rooms[room_number]
-            return room
-        return None
+        return self.store.get_room(room_number)
 
     def create_room(self, room_number, room_url):
-        if room_number not in self.rooms:
-            room = Room(room_number, room_url)
-            self.rooms[room_number] = room
+        room = Room(room_number, room_url)
+        if self.store.add_room(room):
+            if self.journal is not None:
+                self.journal.record_room(room)
             return room
         return None
 
     def delete_room(self, room_number: str) -> bool:
-        if room_number in self.rooms:
-            del self.rooms[room_number]
+        if self.store.delete_room(room_number):
+            if self.journal is not None:
+                self.journal.record_delete(room_number)
             return True
         return False
 
+    def get_room_number_by_email(self, email: str):
+        return self.store.get_user_room(email)
+
     def get_room_by_email(self, email: str):
-        if email in self.user_to_room:
-            return self.user_to_room[email]
+        room_number = self.store.get_user_room(email)
+        if room_number is not None:
+            return self.get_room(room_number)
         return None
 
     def create_user_to_room(self, email: str, room: Room) -> bool:
-        if email not in self.user_to_room:
-            self.user_to_room[email] = room
+        return self.store.set_user_room(email, room.room_number)
+
+    def join(self, room: Room, user: User) -> bool:
+        # 在房间锁内登记用户索引并加入房间：用户索引原子地占位，防止并发请求让同一用户加入两个房间；
+        # 房间只在持有房间锁时删除，加锁后房间仍存在即可安全加入
+        with room.lock:
+            if self.store.get_room(room.room_number) is None:
+                return False
+            if not self.create_user_to_room(user.email, room):
+                return False
+            room.add_user(user)
             return True
-        return False
+
+    def leave(self, room: Room, emails) -> bool:
+        # 成员离开房间并删除用户索引，房间没有成员时删除房间，返回房间是否被删除；多个成员合并为一次广播
+        with room.lock:
+            with room.batch():
+                for email in emails:
+                    room.delete_user(email)
+            for email in emails:
+                self.delete_user_to_room(email)
+            return not room.users and self.delete_room(room.room_number)
 
     def delete_user_to_room(self, email: str) -> bool:
-        if email in self.user_to_room:
-            del self.user_to_room[email]
-            return True
-        return False
+        return self.store.delete_user_room(email)
@@ -0,0 +1,92 @@
+import pytest
+
+from journal import RoomJournal
+from sync import Room, User
+
+
+class Crash(Exception):
+    pass
+
+
+def make_room(room_number: str = 'r1') -> Room:
+    room = Room(room_number, 'http://v')
+    room.users['a@x'] = User('a@x', 'a', '1')
+    return room
+
+
+def crash_while_reading(rooms):
+    # 模拟换下日志之后、写完快照之前进程退出
+    raise Crash()
+    yield
+
+
+def test_replay_after_crash_between_rotate_and_snapshot(tmp_path):
+    journal = RoomJournal(str(tmp_path))
+    journal.load()
+    journal.record_room(make_room())
+    journal.record_patch('r1', {'version': 1, 'room': {'video_identify': 'v1'}})
+    with pytest.raises(Crash):
+        journal.compact(crash_while_reading(()))
+    assert not (tmp_path / 'rooms.snapshot.json').exists()
+    assert (tmp_path / 'rooms.journal.old').exists()
+
+    # 换下日志后的记录写入新日志，重启时先回放旧日志再回放新日志
+    journal.record_patch('r1', {'version': 2, 'users': {'a@x': {'video_progress': 5}}})
+    journal.record_room(make_room('r2'))
+    journal.record_delete('r2')
+
+    rooms = RoomJournal(str(tmp_path)).load()
+    assert list(rooms) == ['r1']
+    assert rooms['r1']['version'] == 2
+    assert rooms['r1']['video_identify'] == 'v1'
+    assert rooms['r1']['users']['a@x']['video_progress'] == 5
+
+
+def test_compact_after_crash_merges_rotated_journal(tmp_path):
+    journal = RoomJournal(str(tmp_path))
+    journal.load()
+    room = make_room()
+    journal.record_room(room)
+    with pytest.raises(Crash):
+        journal.compact(crash_while_reading(()))
+    journal.record_patch('r1', {'version': 1, 'room': {'video_identify': 'v1'}})
+    room.version, room.video_identify = 1, 'v1'
+
+    journal.compact([room])
+    assert not (tmp_path / 'rooms.journal.old').exists()
+    journal.record_patch('r1', {'version': 2, 'room': {'room_url': 'http://w'}})
+
+    restarted = RoomJournal(str(tmp_path))
+    rooms = restarted.load()
+    assert rooms['r1']['version'] == 2
+    assert (rooms['r1']['video_identify'], rooms['r1']['room_url']) == ('v1', 'http://w')
+    assert restarted.seq == journal.seq
+
+
+def test_replay_is_idempotent_over_newer_snapshot(tmp_path):
+    journal = RoomJournal(str(tmp_path))
+    journal.load()
+    room = make_room()
+    journal.record_room(room)
+
+    def modified_during_compaction():
+        # 换下日志后、读取房间状态前房间又被修改，快照中已包含seq之后的记录
+        room.version, room.users['a@x'].video_progress = 1, 7
+        journal.record_patch('r1', {'version': 1, 'users': {'a@x': {'video_progress': 7}}})
+        yield room
+
+    journal.compact(modified_during_compaction())
+    rooms = RoomJournal(str(tmp_path)).load()
+    assert rooms['r1']['version'] == 1
+    assert rooms['r1']['users']['a@x']['video_progress'] == 7
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    journal = RoomJournal(str(tmp_path))
+    journal.load()
+    journal.record_room(make_room())
+    with open(journal.journal_path, 'a', encoding='utf-8') as f:
+        f.write('{"seq": 2, "op": "pat')
+
+    rooms = RoomJournal(str(tmp_path)).load()
+    assert list(rooms) == ['r1']
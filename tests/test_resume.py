@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+from app import create_app
+from sync import Manage, Resumer, Room, User
+
+
+@pytest.fixture(scope='module')
+def app():
+    # 房间状态是进程内单例，整个模块共用一个应用；不登记清理定时器
+    config = {'RESUME_WINDOW': 5, 'REAPER_TICK': 1, 'MEMBER_GRACE_PERIOD': 0, 'SOCKETIO_ASYNC_MODE': 'threading'}
+    app = create_app(config, components=('socketio',))
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def room(app):
+    room = Room('resume-room', 'http://v')
+    user = room.users['a@x'] = User('a@x', 'a', '1')
+    user.socketio, user.video_state, user.video_progress = True, 'onplaying', 30
+    Manage().store.add_room(room)
+    yield room
+    Manage().store.delete_room(room.room_number)
+
+
+@pytest.fixture
+def resumer(app):
+    # 每个测试使用新的实例，不启动后台过期任务，由测试调用expire
+    resumer = Resumer._cls()
+    resumer._started = True
+    return resumer
+
+
+def test_resume_with_matching_token(resumer):
+    token = resumer.issue('s1', 'a@x', 'resume-room', 'json')
+    assert not resumer.resume(token, 's2', 'a@x', 'other-room', 'json')
+    assert not resumer.resume(token, 's2', 'a@x', 'resume-room', 'msgpack')
+    assert not resumer.resume('unknown', 's2', 'a@x', 'resume-room', 'json')
+
+    assert resumer.resume(token, 's2', 'a@x', 'resume-room', 'json')
+    # 旧连接迟到的断开事件不再影响成员状态
+    assert not resumer.is_current('s1', 'a@x')
+    assert resumer.is_current('s2', 'a@x')
+
+
+def test_new_token_replaces_old_one(resumer):
+    old = resumer.issue('s1', 'a@x', 'resume-room', 'json')
+    resumer.issue('s2', 'a@x', 'resume-room', 'json')
+    assert not resumer.resume(old, 's3', 'a@x', 'resume-room', 'json')
+    assert not resumer.suspend('s1', 'a@x')
+
+
+def test_suspended_session_expires_after_window(resumer, room):
+    token = resumer.issue('s1', 'a@x', 'resume-room', 'json')
+    now = time.monotonic()
+    assert resumer.suspend('s1', 'a@x')
+
+    resumer.expire(now + 3)
+    assert room.users['a@x'].socketio
+
+    resumer.expire(now + 6)
+    user = room.users['a@x']
+    assert (user.socketio, user.video_state, user.video_progress) == (False, 'close', 0)
+    assert not resumer.resume(token, 's2', 'a@x', 'resume-room', 'json')
+    assert resumer.is_current('s2', 'a@x')
+
+
+def test_resumed_session_does_not_expire(resumer, room):
+    token = resumer.issue('s1', 'a@x', 'resume-room', 'json')
+    now = time.monotonic()
+    resumer.suspend('s1', 'a@x')
+    assert resumer.resume(token, 's2', 'a@x', 'resume-room', 'json')
+
+    resumer.expire(now + 6)
+    user = room.users['a@x']
+    assert (user.socketio, user.video_state, user.video_progress) == (True, 'onplaying', 30)
@@ -0,0 +1,135 @@
+import fakeredis
+import pytest
+
+from store import RedisStore, RoomOwnedElsewhere
+from sync import Room
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def make_store(server, worker_id: str = None, lease_ttl: float = 15):
+    # 指定worker_id时模拟分片模式下负责全部房间的worker
+    store = RedisStore(Room, fakeredis.FakeRedis(server=server))
+    if worker_id:
+        store.worker_id = worker_id
+        store.lease_ttl = lease_ttl
+        store.owner_check = lambda room_number: True
+    return store
+
+
+def stored_room(server, room_number: str):
+    return make_store(server).get_room(room_number)
+
+
+def test_round_trip(server):
+    store = make_store(server)
+    room = Room('r1', 'http://v')
+    assert store.add_room(room)
+    assert not store.add_room(Room('r1', 'http://other'))
+    assert store.set_user_room('a@x', 'r1')
+    assert not store.set_user_room('a@x', 'r2')
+
+    other = make_store(server)
+    assert other.get_user_room('a@x') == 'r1'
+    loaded = other.get_room('r1')
+    with other.transaction(loaded):
+        loaded.video_identify = 'v1'
+
+    # 非owner的修改在事务结束时直接写回，另一个进程再次访问时加载到最新状态
+    assert store.get_room('r1') is room
+    assert room.video_identify == 'v1'
+    assert store.stats() == {'rooms': 1, 'users': 1}
+
+    assert other.delete_room('r1')
+    assert store.get_room('r1') is None
+
+
+def test_owner_flushes_dirty_rooms(server):
+    store = make_store(server, 'w1')
+    room = Room('r1', 'http://v')
+    assert store.add_room(room)
+    assert store._is_owned('r1')
+
+    # owner只修改内存中的房间，写回之前其他进程看到的仍是旧状态
+    with store.transaction(room):
+        room.video_identify = 'v1'
+    assert store.dirty == {'r1'}
+    assert stored_room(server, 'r1').video_identify == ''
+
+    store.flush_rooms()
+    assert store.dirty == set()
+    assert stored_room(server, 'r1').video_identify == 'v1'
+
+
+def test_new_owner_waits_for_release(server):
+    old, new = make_store(server, 'w1'), make_store(server, 'w2')
+    room = Room('r1', 'http://v')
+    old.add_room(room)
+    with old.transaction(room):
+        room.video_identify = 'v1'
+
+    # 旧owner持有租约期间新owner不能在内存中接管
+    new.get_room('r1')
+    assert not new._is_owned('r1')
+
+    old.release_rooms(['r1'])
+    assert new.get_room('r1').video_identify == 'v1'
+    assert new._is_owned('r1')
+    assert not old._is_owned('r1')
+
+
+def test_flush_after_losing_lease_is_dropped(server):
+    old, new = make_store(server, 'w1'), make_store(server, 'w2')
+    room = Room('r1', 'http://v')
+    old.add_room(room)
+    with old.transaction(room):
+        room.video_identify = 'stale'
+
+    # 旧owner停顿期间租约过期并被新owner取得
+    fakeredis.FakeRedis(server=server).delete('watch-together:owner:r1')
+    taken = new.get_room('r1')
+    with new.transaction(taken):
+        taken.video_identify = 'fresh'
+    new.flush_rooms()
+
+    old.flush_rooms()
+    assert old.dirty == set()
+    assert not old._is_owned('r1')
+    assert stored_room(server, 'r1').video_identify == 'fresh'
+
+
+def test_non_owner_write_refused_while_lease_held(server):
+    owner, other = make_store(server, 'w1'), make_store(server)
+    room = Room('r1', 'http://v')
+    owner.add_room(room)
+    with owner.transaction(room):
+        room.video_identify = 'owner'
+
+    # 租约持有者的内存状态尚未写回，其他进程的写入会被下一次写回覆盖，直接拒绝
+    loaded = other.get_room('r1')
+    with pytest.raises(RoomOwnedElsewhere):
+        with other.transaction(loaded):
+            loaded.video_identify = 'other'
+
+    owner.flush_rooms()
+    assert stored_room(server, 'r1').video_identify == 'owner'
+
+
+def test_non_owner_write_aborted_when_lease_claimed(server):
+    other, owner = make_store(server), make_store(server, 'w1')
+    other.add_room(Room('r1', 'http://v'))
+
+    loaded = other.get_room('r1')
+    with pytest.raises(RoomOwnedElsewhere):
+        with other.transaction(loaded):
+            loaded.video_identify = 'other'
+            # 事务执行期间owner取得租约并开始在内存中修改
+            claimed = owner.get_room('r1')
+            with owner.transaction(claimed):
+                claimed.video_identify = 'owner'
+
+    owner.flush_rooms()
+    assert stored_room(server, 'r1').video_identify == 'owner'
@@ -0,0 +1,56 @@
+import pytest
+
+import utils
+from utils import TimerWheel
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # 可控的monotonic时钟
+    now = [1000.0]
+    monkeypatch.setattr(utils.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_timer_expires_after_delay(clock):
+    wheel = TimerWheel(tick=1, slots=8)
+    wheel.schedule('a', 3)
+    assert wheel.advance(clock[0] + 2.5) == []
+    assert wheel.advance(clock[0] + 3) == ['a']
+    assert len(wheel) == 0
+    assert wheel.advance(clock[0] + 20) == []
+
+
+def test_timer_longer_than_one_round(clock):
+    wheel = TimerWheel(tick=1, slots=4)
+    wheel.schedule('a', 10)
+    wheel.schedule('b', 2)
+    assert wheel.advance(clock[0] + 2) == ['b']
+    assert wheel.advance(clock[0] + 9) == []
+    assert wheel.advance(clock[0] + 10) == ['a']
+
+
+def test_reschedule_and_cancel(clock):
+    wheel = TimerWheel(tick=1, slots=8)
+    wheel.schedule('a', 2)
+    wheel.schedule('a', 5)  # 覆盖之前的定时器
+    wheel.schedule('b', 2)
+    assert wheel.cancel('b')
+    assert not wheel.cancel('b')
+    assert wheel.advance(clock[0] + 4) == []
+    assert wheel.advance(clock[0] + 5) == ['a']
+
+
+def test_schedule_after_idle_period_starts_from_now(clock):
+    wheel = TimerWheel(tick=1, slots=8)
+    clock[0] += 500  # 空闲期间没有推进
+    wheel.schedule('a', 3)
+    assert wheel.advance(clock[0] + 1) == []
+    assert wheel.advance(clock[0] + 3) == ['a']
+
+
+def test_delay_rounds_up_to_whole_ticks(clock):
+    wheel = TimerWheel(tick=1, slots=8)
+    wheel.schedule('a', 0.2)
+    assert wheel.advance(clock[0] + 0.5) == []
+    assert wheel.advance(clock[0] + 1) == ['a']
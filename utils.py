@@ -1,7 +1,169 @@
 import random
 import string
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 def get_random_string():
     result = ''.join(random.sample(string.ascii_letters + string.digits, 8))
     return result
+
+
+def now_ms() -> int:
+    # 服务端时钟，毫秒时间戳
+    return int(time.time() * 1000)
+
+
+class LRUCache:
+    # 带过期时间的LRU缓存，超过maxsize时淘汰最久未使用的条目，hits/misses用于统计命中率
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()  # key -> (expire_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class NativePool:
+    # 在原生线程中执行阻塞的CPU密集任务（如密码散列），避免阻塞eventlet/gevent的事件循环
+    # 同时执行和排队的任务总数不超过max_workers + max_pending，超出时立即抛出PoolBusy
+    def __init__(self, async_mode: str = None, max_workers: int = 4, max_pending: int = 32):
+        self.rejected = 0
+        self._executor = None
+        self._gevent_pool = None
+        self.configure(async_mode, max_workers, max_pending)
+
+    def configure(self, async_mode: str, max_workers: int, max_pending: int):
+        # 应用初始化时按配置重新设置，只能在没有任务执行时调用
+        self.async_mode = async_mode
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._gevent_pool is not None:
+            self._gevent_pool.kill()
+            self._gevent_pool = None
+        if async_mode == 'eventlet':
+            # eventlet的tpool是进程内唯一的线程池，大小在首次使用时确定，应用初始化时按max_workers设置
+            from eventlet import tpool
+            tpool.set_num_threads(max_workers)
+
+    def _execute(self, func, *args):
+        if self.async_mode == 'eventlet':
+            from eventlet import tpool
+            return tpool.execute(func, *args)
+        if self.async_mode == 'gevent':
+            # 使用独立的线程池，不占用hub线程池（DNS解析等也在其中执行）
+            if self._gevent_pool is None:
+                from gevent.threadpool import ThreadPool
+                self._gevent_pool = ThreadPool(self.max_workers)
+            return self._gevent_pool.apply(func, args)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='native-pool')
+        return self._executor.submit(func, *args).result()
+
+    def run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PoolBusy('native pool is full')
+        try:
+            return self._execute(func, *args)
+        finally:
+            self._slots.release()
+
+
+class TimerWheel:
+    # 哈希时间轮，按key登记定时器，登记、取消和每次推进的摊还开销都是O(1)
+    # 超过一圈的定时器记录剩余圈数，同一个key重复登记时覆盖之前的定时器
+    def __init__(self, tick: float = 1, slots: int = 512):
+        self.tick = tick
+        self.slots: list[dict] = [{} for _ in range(slots)]  # 每个槽 key -> 剩余圈数
+        self.timers: dict = {}  # key -> 所在槽
+        self.cursor = 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, delay: float):
+        ticks = max(1, int(-(-delay // self.tick)))  # 向上取整，至少等待一个tick
+        with self._lock:
+            if not self.timers:
+                # 空闲期间没有推进指针，从现在开始计时，否则下一次advance会补推空闲的tick，定时器几乎立即到期
+                self._last = time.monotonic()
+            self._cancel(key)
+            slot = (self.cursor + ticks) % len(self.slots)
+            self.slots[slot][key] = (ticks - 1) // len(self.slots)
+            self.timers[key] = slot
+
+    def cancel(self, key) -> bool:
+        with self._lock:
+            return self._cancel(key)
+
+    def _cancel(self, key) -> bool:
+        slot = self.timers.pop(key, None)
+        if slot is None:
+            return False
+        del self.slots[slot][key]
+        return True
+
+    def advance(self, now: float = None) -> list:
+        # 按经过的时间推进指针，返回到期的key
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self._lock:
+            while now - self._last >= self.tick:
+                self._last += self.tick
+                self.cursor = (self.cursor + 1) % len(self.slots)
+                bucket = self.slots[self.cursor]
+                for key, rounds in list(bucket.items()):
+                    if rounds:
+                        bucket[key] = rounds - 1
+                    else:
+                        del bucket[key]
+                        del self.timers[key]
+                        expired.append(key)
+        return expired
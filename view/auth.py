@@ -1,25 +1,44 @@
+import hashlib
 import json
 import time
 
-from flask import request, make_response, render_template
+from flask import Blueprint, current_app, request, make_response
 from flask_login import login_user, login_required, logout_user, current_user
-from app import app, db, login_manager
-from models import User
+from sqlalchemy.exc import IntegrityError
+from compression import StaticPage
+from extensions import login_manager
+from models import db, User, user_cache
+from utils import PoolBusy
 from sync import Manage
 
 
+bp = Blueprint('auth', __name__)
 manage = Manage()
+pages: dict[str, StaticPage] = {}
+
+
+@bp.record_once
+def render_pages(state):
+    # 登录注册页和隐私政策页不随用户变化，注册蓝图时渲染一次
+    with state.app.app_context():
+        for template in ('login.html', 'policy.html'):
+            pages[template] = StaticPage(template)
 
 
 # 用户加载回调函数
 @login_manager.user_loader
-def load_user(email: str):                # 创建用户加载回调函数，接受用户 Email 作为参数
-    user = User.query.get(str(email))     # 用 Email 作为 User 模型的主键查询对应的用户
+def load_user(user_id: str):              # 创建用户加载回调函数，接受会话中保存的用户 id 作为参数
+    user = user_cache.get(str(user_id))   # 优先从缓存获取，socket事件不再每次查询数据库
+    if user is None:
+        user = User.query.get(str(user_id))
+        if user:
+            db.session.expunge(user)      # 与会话分离，避免会话提交或关闭后缓存对象过期
+            user_cache.set(str(user_id), user)
     return user
 
 
 # 用户注册
-@app.route('/sign-up', methods=['GET', 'POST'])
+@bp.route('/sign-up', methods=['GET', 'POST'])
 def sign_up():
     if request.method == 'POST':
         post_data = request.get_json()
@@ -42,16 +61,27 @@ def sign_up():
         user = User()
         user.email = account
         user.nickname = nickname
-        user.set_password(password=password)
+        try:
+            user.set_password(password=password)
+        except PoolBusy:
+            rsp = {'code': 1, 'msg': '服务繁忙，请稍后重试', 'data': {}}
+            return make_response(rsp, 503)
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 并发注册同一账号时由唯一索引拦截
+            db.session.rollback()
+            rsp = {'code': 1, 'msg': '账号已被注册', 'data': {}}
+            return make_response(rsp, 400)
+        user_cache.invalidate(str(user.id))
         login_user(user, remember=True)
 
         rsp = {'code': 0, 'msg': '注册成功', 'data': {'user': {'nickname': user.nickname, 'email': user.email}}}
         return make_response(rsp, 200)
 
     if request.method == 'GET':
-        return render_template("login.html")
+        return pages['login.html'].response()
 
     # 兜底回复
     rsp = {'code': 1, 'msg': '注册失败', 'data': {}}
@@ -59,7 +89,7 @@ def sign_up():
 
 
 # 用户登录
-@app.route('/sign-in', methods=['GET', 'POST'])
+@bp.route('/sign-in', methods=['GET', 'POST'])
 def sign_in():
     if request.method == 'POST':
         post_data = request.get_json()
@@ -75,17 +105,23 @@ def sign_in():
         user = User.query.filter_by(email=account).first()
 
         # 验证用户名和密码是否一致
-        if user and user.validate_password(password):
+        try:
+            password_valid = bool(user) and user.validate_password(password)
+        except PoolBusy:
+            rsp = {'code': 1, 'msg': '服务繁忙，请稍后重试', 'data': {}}
+            return make_response(rsp, 503)
+
+        if password_valid:
             login_user(user, remember=True)
             rsp = {'code': 0, 'msg': '登录成功',  'data': {'user': {'nickname': user.nickname, 'email': user.email}}}
-            app.logger.info(rsp)
+            current_app.logger.info(rsp)
             return make_response(rsp, 200)
 
         rsp = {'code': 1, 'msg': '登录验证失败', 'data': {}}
         return make_response(rsp, 400)
 
     if request.method == 'GET':
-        return render_template("login.html")
+        return pages['login.html'].response()
 
         # 兜底回复
     rsp = {'code': 1, 'msg': '登录失败', 'data': {}}
@@ -93,7 +129,7 @@ def sign_in():
 
 
 # 用户登出
-@app.route('/sign-out', methods=['GET', 'POST'])
+@bp.route('/sign-out', methods=['GET', 'POST'])
 @login_required
 def sign_out():
     try:
@@ -106,26 +142,36 @@ def sign_out():
         return make_response(rsp)
 
 
-@app.route('/profile', methods=['GET', 'POST'])
+@bp.route('/profile', methods=['GET', 'POST'])
 def profile():
     # 用户未登录
     if not current_user.is_authenticated:
         return make_response({'code': 1, 'msg': 'user not authenticated', 'data': {}})
 
     room = manage.get_room_by_email(current_user.email)
-    user_info = current_user.to_dict(rules=('-password_hash', '-id'))
-
-    if room:
-        user_info = dict(room.users[current_user.email])
 
     # 用户未加入房间
     if not room:
-        return make_response({'code': 0, 'msg': 'success', 'data': {'user': user_info}})
-
-    room_info = room.get_room_info()
-    return make_response({'code': 0, 'msg': 'success', 'data': {'user': user_info, 'room': room_info}})
-
-
-@app.route('/policy', methods=['GET'])
+        user_info = current_user.to_dict(rules=('-password_hash', '-id'))
+        rsp = make_response({'code': 0, 'msg': 'success', 'data': {'user': user_info}})
+        rsp.add_etag()
+        return rsp.make_conditional(request)
+
+    # 房间序列化结果按修改缓存，ETag由房间内容散列和当前用户组成，未变化时返回304
+    room_json, room_etag = room.get_room_json()
+    etag = '%s-%s' % (room_etag, hashlib.md5(current_user.email.encode()).hexdigest()[:8])
+    if request.if_none_match.contains_weak(etag):
+        rsp = current_app.response_class(status=304)
+        rsp.set_etag(etag)
+        return rsp
+
+    user_json = json.dumps(room.get_room_info()['users'][current_user.email], separators=(',', ':'))
+    body = '{"code":0,"msg":"success","data":{"user":%s,"room":%s}}' % (user_json, room_json)
+    rsp = current_app.response_class(body, mimetype='application/json')
+    rsp.set_etag(etag)
+    return rsp
+
+
+@bp.route('/policy', methods=['GET'])
 def policy():
-    return render_template('policy.html')
+    return pages['policy.html'].response()
@@ -1,19 +1,45 @@
 import functools
-import json
 
-from flask import render_template, make_response, request
+from flask import Blueprint, current_app, render_template, make_response, request, redirect
 from flask_login import login_required, current_user
+import flask_socketio
 from flask_socketio import emit, disconnect, join_room, leave_room
 
-from app import app, socketio, socketio_namespace
-from sync import Room, User, Manage
+from extensions import socketio, socketio_namespace
+import wire
+from log import LazyJson
+from metrics import track_event, connected_sockets
+from sync import Room, User, Manage, RoomFlusher, ClockSync, Reaper, Outbox, DriftMonitor, Resumer
 
 
+bp = Blueprint('logit', __name__)
 manage = Manage()
+flusher = RoomFlusher()
+clock_sync = ClockSync()
+reaper = Reaper()
+outbox = Outbox()
+resumer = Resumer()
+drift_monitor = DriftMonitor()
+counted_sids: set = set()  # 已计入connected_sockets的连接；被拒绝或重定向断开的连接未计入，断开时不扣减
 
 
-@app.route('/create-room', methods=['POST'])
+def room_affinity(f):
+    # 分片模式下按请求中的roomNumber将HTTP请求307重定向到房间owner所在的worker
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        post_data = request.get_json(silent=True) or {}
+        room_number = str(post_data.get('roomNumber', ''))
+        worker_id, worker_url = manage.router.owner(room_number)
+        if worker_id != manage.router.worker_id:
+            current_app.logger.info('room(%s) owned by worker(%s), redirect', room_number, worker_id)
+            return redirect(worker_url.rstrip('/') + request.path, code=307)
+        return f(*args, **kwargs)
+    return wrapped
+
+
+@bp.route('/create-room', methods=['POST'])
 @login_required
+@room_affinity
 def _create_room():
     post_data = request.get_json()
     tab_id = str(post_data.get('tabId', ''))
@@ -23,48 +49,55 @@ def _create_room():
     # 判断room url
     if not room_url:
         msg = 'room url (%s) invalid' % room_url
-        app.logger.info(msg)
+        current_app.logger.info(msg)
         return make_response({'code': 1, 'msg': msg, 'data': {}})
 
     # 判断tab id是否为有效值
     if not tab_id.isnumeric():
         msg = 'tab id (%s) invalid' % tab_id
-        app.logger.info(msg)
+        current_app.logger.info(msg)
         return make_response({'code': 1, 'msg': msg, 'data': {}})
 
     # 判断房间号是否为空值
     if room_number == '' or room_number == 'None':
         msg = 'room number(%s) cannot be empty' % room_number
-        app.logger.info(msg)
+        current_app.logger.info(msg)
         return make_response({'code': 1, 'msg': msg, 'data': {}})
 
     # 判断用户是否已经进入房间
-    if current_user.email in manage.user_to_room:
-        cur_room_number = manage.user_to_room[current_user.email].room_number
+    cur_room = manage.get_room_by_email(current_user.email)
+    if cur_room:
+        cur_room_number = cur_room.room_number
         msg = '%s already in room(%s)' % (current_user.nickname, cur_room_number)
-        app.logger.info(msg)
+        current_app.logger.info(msg)
         return make_response({'code': 1, 'msg': msg, 'data': {}})
 
     # 判断此次期望创建的房间是否已存在
-    if room_number in manage.rooms:
+    room = manage.create_room(room_number, room_url)
+    if room is None:
         msg = 'room(%s) already exists' % room_number
-        app.logger.info(msg)
+        current_app.logger.info(msg)
         return make_response({'code': 1, 'msg': msg, 'data': {}})
 
-    room = manage.create_room(room_number, room_url)
     user = User(current_user.email, current_user.nickname, tab_id)
-    room.add_user(user)
-    manage.create_user_to_room(user.email, room)
+    if not manage.join(room, user):
+        # 并发请求已让用户加入其他房间
+        manage.delete_room(room_number)
+        msg = '%s already in room' % current_user.nickname
+        current_app.logger.info(msg)
+        return make_response({'code': 1, 'msg': msg, 'data': {}})
+    reaper.schedule(user.email)  # socket连接后取消
 
     msg = 'room(%s) create success' % room_number
-    app.logger.info(msg)
+    current_app.logger.info(msg)
     room_info = room.get_room_info()
     user_info = dict(user)
     return make_response({'code': 0, 'msg': msg, 'data': {'room': room_info, 'user': user_info}})
 
 
-@app.route('/join-room', methods=['POST'])
+@bp.route('/join-room', methods=['POST'])
 @login_required
+@room_affinity
 def _join_room():
     post_data = request.get_json()
     room_number = str(post_data.get('roomNumber', None))
@@ -73,65 +106,70 @@ def _join_room():
     # 判断tab id是否为有效值
     if not tab_id.isnumeric():
         msg = 'tab id (%s) invalid' % tab_id
-        app.logger.info(msg)
+        current_app.logger.info(msg)
         return make_response({'code': 1, 'msg': msg, 'data': {}})
 
     # 判断是否已经进入房间
-    if current_user.email in manage.user_to_room:
-        cur_room_number = manage.user_to_room[current_user.email].room_number
+    cur_room = manage.get_room_by_email(current_user.email)
+    if cur_room:
+        cur_room_number = cur_room.room_number
         msg = '%s already in room(%s)' % (current_user.nickname, cur_room_number)
-        app.logger.info(msg)
+        current_app.logger.info(msg)
         return make_response({'code': 1, 'msg': msg, 'data': {}})
 
     # 判断期望进入的房间是否存在
-    if room_number not in manage.rooms:
+    room = manage.get_room(room_number)
+    if room is None:
         msg = 'room(%s) does not exist' % room_number
-        app.logger.info(msg)
+        current_app.logger.info(msg)
         return make_response({'code': 1, 'msg': msg, 'data': {}})
 
-    room = manage.get_room(room_number)
     user = User(current_user.email, current_user.nickname, tab_id)
-    room.add_user(user)
-    manage.create_user_to_room(user.email, room)
+    if not manage.join(room, user):
+        # 房间已被删除，或并发请求已让用户加入其他房间
+        msg = '%s join room(%s) failed' % (current_user.nickname, room_number)
+        current_app.logger.info(msg)
+        return make_response({'code': 1, 'msg': msg, 'data': {}})
+    reaper.schedule(user.email)  # socket连接后取消
 
     room_info = room.get_room_info()
     user_info = dict(user)
+    playback = room.current_playback()  # 加入后直接跳转到当前播放位置
 
     msg = '%s join room(%s)' % (user.nickname, room_number)
-    app.logger.info(msg)
-    return make_response({'code': 0, 'msg': msg, 'data': {'room': room_info, 'user': user_info}})
+    current_app.logger.info(msg)
+    data = {'room': room_info, 'user': user_info, 'playback': playback}
+    return make_response({'code': 0, 'msg': msg, 'data': data})
 
 
-@app.route('/leave-room', methods=['POST'])
+@bp.route('/leave-room', methods=['POST'])
 @login_required
+@room_affinity
 def _leave_room():
     post_data = request.get_json()
     room_number = str(post_data.get('roomNumber', None))
 
-    if room_number not in manage.rooms:
-        msg = 'room(%s) does not exist' % room_number
-        app.logger.info(msg)
-        return make_response({'code': 1, 'msg': msg, 'data': {}})
-
     room = manage.get_room(room_number)
-
-    if current_user.email not in room.users:
-        msg = '%s not in room(%s)' % (current_user.email, room_number)
-        app.logger.info(msg)
+    if room is None:
+        msg = 'room(%s) does not exist' % room_number
+        current_app.logger.info(msg)
         return make_response({'code': 1, 'msg': msg, 'data': {}})
 
-    room_info = room.get_room_info()
-    user_info = dict(room.users[current_user.email])
+    with room.lock:
+        if current_user.email not in room.users:
+            msg = '%s not in room(%s)' % (current_user.email, room_number)
+            current_app.logger.info(msg)
+            return make_response({'code': 1, 'msg': msg, 'data': {}})
 
-    room.delete_user(current_user.email)
-    manage.delete_user_to_room(current_user.email)
+        room_info = room.get_room_info()
+        user_info = dict(room.users[current_user.email])
 
-    if len(room.users) == 0:
-        manage.delete_room(room_number)
-        app.logger.info('room(%s) had been delete' % room_number)
+        reaper.cancel(current_user.email)
+        if manage.leave(room, [current_user.email]):
+            current_app.logger.info('room(%s) had been delete' % room_number)
 
     msg = '%s leave room(%s)' % (current_user.nickname, room_number)
-    app.logger.info(msg)
+    current_app.logger.info(msg)
     return make_response({'code': 0, 'msg': msg, 'data': {'user': user_info, 'room': room_info}})
 
 
@@ -139,44 +177,94 @@ def authenticated_only(f):
     @functools.wraps(f)
     def wrapped(*args, **kwargs):
         if not current_user.is_authenticated:
-            app.logger.info('socket authenticated fail')
+            current_app.logger.info('socket authenticated fail')
             disconnect()
         else:
             return f(*args, **kwargs)
     return wrapped
 
 
+def socket_room_affinity(f):
+    # 分片模式下socket只能连接到所在房间的owner，否则通知客户端重连到owner并断开
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        room_number = manage.get_room_number_by_email(current_user.email)
+        if room_number is not None:
+            worker_id, worker_url = manage.router.owner(room_number)
+            if worker_id != manage.router.worker_id:
+                current_app.logger.info('room(%s) owned by worker(%s), redirect socket', room_number, worker_id)
+                emit('redirect', {'url': worker_url})
+                flask_socketio.disconnect()
+                return
+        return f(*args, **kwargs)
+    return wrapped
+
+
 @socketio.on('connect', namespace=socketio_namespace)
+@track_event('connect')
 @authenticated_only
-def connected():
+@socket_room_affinity
+def connected(auth=None):
     nickname = current_user.nickname
     email = current_user.email
+    counted_sids.add(request.sid)
+    connected_sockets.inc()
     room = manage.get_room_by_email(email)
+    flusher.start()
+    clock_sync.start()
+    clock_sync.ping(request.sid)
+    drift_monitor.start()
     if room:
-        join_room(room.room_number)
-        room.set_user_socketio(email, True)
-        room.set_user_video_state(email, 'init')
-    app.logger.info('%s socket connected...' % nickname)
+        reaper.cancel(email)
+        # 连接时通过 ?codec=msgpack 请求二进制编码，服务端不支持时回退为JSON
+        codec = wire.negotiate(request.args.get('codec'))
+        # 断线重连时通过 auth={'resume': token} 或 ?resume=token 携带上次连接签发的令牌，
+        # 令牌有效时成员状态未曾改变，不再广播，只向自己发送完整快照补齐断线期间的变化
+        token = auth.get('resume') if isinstance(auth, dict) else None
+        token = token or request.args.get('resume')
+        if not (token and resumer.resume(token, request.sid, email, room.room_number, codec)):
+            # 先广播增量给其他成员，再加入房间并向自己发送完整快照
+            room.update_user(email, socketio=True, video_state='init', codec=codec)
+        join_room(room.channel(codec))
+        outbox.register(request.sid, email, room.room_number, codec)
+        drift_monitor.track(request.sid, room, email)
+        room.emit_room_snapshot(codec)
+        room.emit_playback(codec)
+        room.emit_resume_token(resumer.issue(request.sid, email, room.room_number, codec), resumer.window, codec)
+    current_app.logger.info('%s socket connected...', nickname)
 
 
 @socketio.on('disconnect', namespace=socketio_namespace)
+@track_event('disconnect')
 @authenticated_only
 def disconnect():
     nickname = current_user.nickname
     email = current_user.email
+    # 被拒绝或重定向到owner的连接从未加入房间，断开时不能修改房间状态（本进程不是owner）
+    if request.sid not in counted_sids:
+        return
+    counted_sids.discard(request.sid)
+    connected_sockets.dec()
+    outbox.unregister(request.sid)
+    drift_monitor.untrack(request.sid)
     room = manage.get_room_by_email(email)
     if room:
-        leave_room(room.room_number)
-        room.set_user_socketio(email, False)
-        room.set_user_video_state(email, 'close')
-        room.set_user_video_progress(email, 0)
-    app.logger.info('%s socket disconnected...' % nickname)
+        leave_room(room.channel(room.users[email].codec))
+        if not resumer.is_current(request.sid, email):
+            pass  # 已在新连接上恢复，旧连接的断开不影响成员状态
+        elif not resumer.suspend(request.sid, email):
+            room.update_user(email, socketio=False, video_state='close', video_progress=0)
+            reaper.schedule(email)
+    current_app.logger.info('%s socket disconnected...', nickname)
 
 
 @socketio.on('updateInfo', namespace=socketio_namespace)
+@track_event('updateInfo')
 @authenticated_only
+@socket_room_affinity
 def update_user_info(data):
-    app.logger.info('socket update_user_info: %s' % json.dumps(data))
+    data = wire.decode(data)
+    current_app.logger.info('socket update_user_info: %s', LazyJson(data), extra={'event': 'updateInfo'})
 
     email = current_user.email
     room = manage.get_room_by_email(email)
@@ -187,41 +275,73 @@ def update_user_info(data):
     current_socketio = data.get('currentSocketio')
 
     if room:
-        if video_identify:
-            room.video_identify = str(video_identify)
+        reports = {}
         if current_progress:
-            room.set_user_video_progress(email, current_progress)
+            reports['video_progress'] = current_progress
         if current_state:
-            room.set_user_video_state(email, current_state)
-        if current_socketio:
-            room.set_user_socketio(email, current_socketio)
-        app.logger.info('%s update user info update room success!' % email)
+            reports['video_state'] = current_state
+
+        # 进度和状态上报交给RoomFlusher定时合并广播，其余字段立即广播且一条消息只广播一次
+        room.report_user(email, **reports)
+        if video_identify or current_socketio:
+            with room.batch():
+                if video_identify:
+                    room.set_video_identify(str(video_identify))
+                if current_socketio:
+                    room.update_user(email, socketio=current_socketio)
+        current_app.logger.info('%s update user info update room success!', email, extra={'event': 'updateInfo'})
 
 
 @socketio.on('sync', namespace=socketio_namespace)
+@track_event('sync')
 @authenticated_only
+@socket_room_affinity
 def sync_event(data):
+    data = wire.decode(data)
     email = current_user.email
     room = manage.get_room_by_email(email)
     action = data.get('action', '')
 
-    app.logger.info('%s sync event: %s' % (email, json.dumps(data)))
+    current_app.logger.info('%s sync event: %s', email, LazyJson(data), extra={'event': action or 'sync'})
 
     if action == 'init':
         time = data.get('time')
-        room.init_new_sync_state()
-        room.emit_pause_and_jump_order(time, 'sync')
+        with room.lock:  # 并发的sync请求按顺序创建屏障和发送指令
+            room.init_new_sync_state()
+            room.emit_pause_and_jump_order(time, 'sync')
 
     elif action == 'updateState':
         state = data.get('state')
-        room.update_sync_state(email, state)
+        generation = data.get('generation')
+        room.update_sync_state(email, state, generation)
 
     elif action == 'updateUrl':
         url = str(data.get('url'))
-        room.room_url = url
-        room.emit_update_url_order(url)
-
+        with room.lock:
+            room.set_room_url(url)
+            room.emit_update_url_order(url)
 
 
+@socketio.on('resync', namespace=socketio_namespace)
+@track_event('resync')
+@authenticated_only
+@socket_room_affinity
+def resync_event():
+    # 客户端检测到room-patch版本不连续时请求完整快照
+    room = manage.get_room_by_email(current_user.email)
+    if room:
+        room.emit_room_snapshot(room.users[current_user.email].codec)
 
 
+@socketio.on('clockPong', namespace=socketio_namespace)
+@track_event('clockPong')
+@authenticated_only
+@socket_room_affinity
+def clock_pong_event(data):
+    data = wire.decode(data)
+    # data: {'t': clockPing中的服务端时间, 'clientTime': 客户端收到clockPing时的本地时间}
+    room = manage.get_room_by_email(current_user.email)
+    sent_at = data.get('t')
+    client_time = data.get('clientTime')
+    if room and isinstance(sent_at, (int, float)) and isinstance(client_time, (int, float)):
+        room.report_clock(current_user.email, int(sent_at), int(client_time))
@@ -0,0 +1,46 @@
+import time
+
+from flask import Blueprint, g, request, Response
+
+from metrics import registry, http_request_seconds, Gauge
+from models import user_cache, password_pool
+from sync import Manage, Outbox
+
+
+bp = Blueprint('monitor', __name__)
+manage = Manage()
+
+
+def room_stats():
+    stats = manage.store.stats()
+    return {('rooms',): stats['rooms'], ('users',): stats['users']}
+
+
+registry.register(Gauge('watch_together_rooms', 'Rooms and room members held by Manage', ('kind',),
+                        callback=room_stats))
+registry.register(Gauge('watch_together_slow_sockets', 'Sockets whose outbound backlog is over the limit',
+                        callback=lambda: Outbox().slow_connections()))
+registry.register(Gauge('watch_together_user_cache', 'user_loader cache size, hits and misses', ('kind',),
+                        callback=lambda: {(k,): v for k, v in user_cache.stats().items()}))
+registry.register(Gauge('watch_together_password_pool_rejected', 'Password hashes rejected because the pool was full',
+                        callback=lambda: password_pool.rejected))
+
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request_latency(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        http_request_seconds.observe(time.perf_counter() - start, request.endpoint or 'unknown', request.method,
+                                     response.status_code)
+    return response
+
+
+# Prometheus抓取接口
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
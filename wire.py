@@ -0,0 +1,83 @@
+try:
+    import msgpack
+except ImportError:  # 未安装msgpack时只支持JSON
+    msgpack = None
+
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+# msgpack编码时将字段名替换为短整数id，新增字段只能追加，不能修改已有id
+FIELD_IDS = {
+    'version': 0,
+    'room_number': 1,
+    'room_url': 2,
+    'video_identify': 3,
+    'users': 4,
+    'room': 5,
+    'email': 6,
+    'nickname': 7,
+    'url': 8,
+    'tab_id': 9,
+    'socketio': 10,
+    'video_state': 11,
+    'video_progress': 12,
+    'rtt': 13,
+    'clock_offset': 14,
+    'codec': 15,
+    'action': 16,
+    'time': 17,
+    'type': 18,
+    'generation': 19,
+    'at': 20,
+    'videoIdentify': 21,
+    'currentState': 22,
+    'currentProgress': 23,
+    'currentSocketio': 24,
+    'state': 25,
+    't': 26,
+    'clientTime': 27,
+    'playback': 28,
+    'position': 29,
+    'rate': 30,
+    'token': 31,
+    'ttl': 32,
+}
+FIELD_NAMES = {v: k for k, v in FIELD_IDS.items()}
+
+
+def negotiate(codec) -> str:
+    # 客户端请求msgpack且服务端已安装msgpack时使用msgpack，否则回退为JSON
+    if codec == MSGPACK and msgpack is not None:
+        return MSGPACK
+    return JSON
+
+
+def _shorten(obj):
+    if isinstance(obj, dict):
+        return {FIELD_IDS.get(k, k): _shorten(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_shorten(v) for v in obj]
+    return obj
+
+
+def _expand(obj):
+    if isinstance(obj, dict):
+        return {FIELD_NAMES.get(k, k): _expand(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_expand(v) for v in obj]
+    return obj
+
+
+def encode(data, codec: str):
+    # JSON由socket.io自行序列化，原样返回；msgpack返回二进制
+    if codec == MSGPACK:
+        return msgpack.packb(_shorten(data), use_bin_type=True)
+    return data
+
+
+def decode(data):
+    # 客户端发送二进制时按msgpack解码，其余按JSON对象原样返回
+    if isinstance(data, (bytes, bytearray)) and msgpack is not None:
+        return _expand(msgpack.unpackb(data, raw=False, strict_map_key=False))
+    return data